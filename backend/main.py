@@ -1,24 +1,32 @@
 """
 FastAPI backend that exposes Claude Agent SDK via OpenAI Responses API format.
 """
+import asyncio
 import os
+import secrets
+import threading
 import time
-import uuid
-from typing import Optional, List, Dict, Any, Literal, AsyncIterator
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
+from typing import (
+    Optional, List, Dict, Any, Literal, AsyncIterator, Callable, Iterator,
+    Deque, Set, Tuple, TypedDict,
+)
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, Field
-import json
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 from claude_agent_sdk import (
     ClaudeSDKClient,
     ClaudeAgentOptions,
     AssistantMessage,
     TextBlock,
     ResultMessage,
-    SystemMessage,
 )
+from claude_agent_sdk.types import StreamEvent
 
 # Load environment variables
 load_dotenv(dotenv_path="../.env")
@@ -26,29 +34,91 @@ load_dotenv(dotenv_path="../.env")
 # Default model configuration
 DEFAULT_MODEL = os.getenv("MODEL_NAME", "claude-haiku-4-5-20251001")
 
-app = FastAPI(title="Claude Agent API", version="0.1.0")
+# Maximum number of stored responses kept in memory
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+
+# Stored responses (and their session IDs) unused for this many seconds
+# expire; 0 keeps them until evicted by size
+CONVERSATION_TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", "3600"))
+
+# Text deltas arriving within this window (ms) are merged into one SSE event;
+# 0 sends every delta as its own event
+STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", "20"))
+
+# Buffered delta text is flushed early once it reaches this many characters
+STREAM_COALESCE_CHARS = 64
+
+# Maximum number of Claude SDK sessions running at once
+MAX_CONCURRENT_CLAUDE = int(os.getenv("MAX_CONCURRENT_CLAUDE", "16"))
+
+# Pre-connected clients kept per (model, streaming) for new conversations;
+# 0 disables the warm pool
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "0"))
+
+# Warm clients left unused for this many seconds are disconnected
+CLIENT_POOL_IDLE_SECONDS = float(os.getenv("CLIENT_POOL_IDLE_SECONDS", "60"))
+
+# Comma-separated models whose new conversations may use the warm pool;
+# requests for any other model always connect on demand
+CLIENT_POOL_MODELS = frozenset(
+    model.strip()
+    for model in os.getenv("CLIENT_POOL_MODELS", DEFAULT_MODEL).split(",")
+    if model.strip()
+)
+
+# Origins allowed to call the API from a browser (Vite and React dev servers)
+CORS_ORIGIN_REGEX = os.getenv("CORS_ORIGIN_REGEX", r"^http://localhost:(5173|3000)$")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the warm client pool reaper and drain the pool on shutdown."""
+    reaper = asyncio.create_task(reap_idle_clients()) if CLIENT_POOL_SIZE > 0 else None
+    yield
+    if reaper:
+        reaper.cancel()
+    await drain_client_pool()
 
-# CORS middleware for local development
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://localhost:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+
+app = FastAPI(
+    title="Claude Agent API",
+    version="0.1.0",
+    lifespan=lifespan,
 )
 
+# CORS middleware for local development. Origins are matched against one
+# precompiled regex; set CORS_ORIGIN_REGEX to "" to skip the middleware
+# entirely (e.g. when served same-origin behind a proxy).
+if CORS_ORIGIN_REGEX:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origin_regex=CORS_ORIGIN_REGEX,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
 
 # ============================================================================
 # OpenAI Responses API Models
 # ============================================================================
 
+# Output and event models are only ever built by the server, never updated,
+# and their schemas are built on first use rather than at import
+_OUTPUT = ConfigDict(defer_build=True, frozen=True, extra="forbid")
+
+
 class OutputTextContent(BaseModel):
+    model_config = _OUTPUT
+
     type: Literal["output_text"] = "output_text"
     text: str
     annotations: List[Any] = Field(default_factory=list)
 
 
 class MessageOutput(BaseModel):
+    model_config = _OUTPUT
+
     type: Literal["message"] = "message"
     id: str
     status: Literal["completed"] = "completed"
@@ -57,12 +127,16 @@ class MessageOutput(BaseModel):
 
 
 class UsageInfo(BaseModel):
+    model_config = _OUTPUT
+
     input_tokens: int
     output_tokens: int
     total_tokens: int
 
 
 class ResponseObject(BaseModel):
+    model_config = _OUTPUT
+
     id: str
     object: Literal["response"] = "response"
     created_at: int
@@ -90,6 +164,8 @@ class CreateResponseRequest(BaseModel):
 
 class StreamEventBase(BaseModel):
     """Base class for all streaming events."""
+    model_config = _OUTPUT
+
     type: str
     sequence_number: int = 0
 
@@ -131,6 +207,21 @@ class ResponseOutputTextDeltaEvent(StreamEventBase):
     delta: str
 
 
+class OutputTextDeltaPayload(TypedDict):
+    """Plain-dict form of ResponseOutputTextDeltaEvent, in the same field order."""
+    type: Literal["response.output_text.delta"]
+    sequence_number: int
+    item_id: str
+    output_index: int
+    content_index: int
+    delta: str
+
+
+# Delta events are sent once per flushed chunk of tokens. Dumping a dict through
+# a prebuilt adapter skips constructing and validating a model per event.
+_DELTA_ADAPTER = TypeAdapter(OutputTextDeltaPayload)
+
+
 class ResponseOutputTextDoneEvent(StreamEventBase):
     """Emitted when text output is complete."""
     type: Literal["response.output_text.done"] = "response.output_text.done"
@@ -162,24 +253,279 @@ class ResponseCompletedEvent(StreamEventBase):
     response: ResponseObject
 
 
+def sse_frame(event_type: str, data: bytes) -> bytes:
+    """Wrap an already-serialized JSON payload in an SSE frame."""
+    return b"event: " + event_type.encode() + b"\ndata: " + data + b"\n\n"
+
+
+def format_sse(event_type: str, model: BaseModel) -> bytes:
+    """
+    Format a streaming event model as an SSE frame.
+
+    Serializes the model straight to JSON with pydantic-core (single pass,
+    no intermediate dict) and returns bytes so Starlette doesn't re-encode
+    each chunk.
+    """
+    return sse_frame(event_type, model.model_dump_json().encode())
+
+
+def format_delta_sse(
+    item_id: str,
+    output_index: int,
+    content_index: int,
+    delta: str,
+    sequence_number: int
+) -> bytes:
+    """Format a response.output_text.delta event as an SSE frame."""
+    return sse_frame("response.output_text.delta", _DELTA_ADAPTER.dump_json({
+        "type": "response.output_text.delta",
+        "sequence_number": sequence_number,
+        "item_id": item_id,
+        "output_index": output_index,
+        "content_index": content_index,
+        "delta": delta,
+    }))
+
+
+# The four frames that open every stream only vary by IDs, timestamp, model
+# and store flag, so they are rendered from pre-serialized templates rather
+# than by building and dumping event models on each request. Field order
+# matches the models' model_dump_json() output.
+_OPENING_FRAMES_TEMPLATE = (
+    'event: response.created\n'
+    'data: {{"type":"response.created","sequence_number":0,"response":{response}}}\n\n'
+    'event: response.in_progress\n'
+    'data: {{"type":"response.in_progress","sequence_number":1,"response":{response}}}\n\n'
+    'event: response.output_item.added\n'
+    'data: {{"type":"response.output_item.added","sequence_number":2,"output_index":0,'
+    '"item":{{"type":"message","id":"{message_id}","status":"completed","role":"assistant",'
+    '"content":[]}}}}\n\n'
+    'event: response.content_part.added\n'
+    'data: {{"type":"response.content_part.added","sequence_number":3,"item_id":"{message_id}",'
+    '"output_index":0,"content_index":0,'
+    '"part":{{"type":"output_text","text":"","annotations":[]}}}}\n\n'
+)
+
+_INITIAL_RESPONSE_TEMPLATE = (
+    '{{"id":"{response_id}","object":"response","created_at":{created_at},'
+    '"status":"in_progress","model":{model},"output":[],'
+    '"usage":{{"input_tokens":0,"output_tokens":0,"total_tokens":0}},'
+    '"store":{store},"metadata":{{}}}}'
+)
+
+
+def completed_response_json(
+    response_id: str,
+    created_at: int,
+    model: str,
+    message: MessageOutput,
+    input_tokens: int,
+    output_tokens: int,
+    store: bool
+) -> bytes:
+    """
+    Serialize a completed ResponseObject without constructing the model.
+
+    Every field other than the message is a plain value we produced, so the
+    dict is dumped with orjson directly instead of being validated as a new
+    ResponseObject first. Key order matches ResponseObject.model_dump_json().
+    """
+    return orjson.dumps({
+        "id": response_id,
+        "object": "response",
+        "created_at": created_at,
+        "status": "completed",
+        "model": model,
+        "output": [message.model_dump()],
+        "usage": {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        },
+        "store": store,
+        "metadata": {},
+    })
+
+
+def opening_sse_frames(
+    response_id: str,
+    message_id: str,
+    model: str,
+    created_at: int,
+    store: bool
+) -> bytes:
+    """
+    Render the response.created, response.in_progress, output_item.added and
+    content_part.added frames (sequence numbers 0-3) as a single chunk.
+
+    `model` comes from the client, so it is JSON-escaped with orjson, which
+    like pydantic-core leaves non-ASCII characters unescaped; the IDs are
+    generated hex strings.
+    """
+    response = _INITIAL_RESPONSE_TEMPLATE.format(
+        response_id=response_id,
+        created_at=created_at,
+        model=orjson.dumps(model).decode(),
+        store="true" if store else "false",
+    )
+    return _OPENING_FRAMES_TEMPLATE.format(
+        response=response,
+        message_id=message_id,
+    ).encode()
+
+
 # ============================================================================
 # In-memory conversation storage (for previous_response_id support)
 # ============================================================================
 
-# Store session IDs for conversation continuity (instead of client instances)
+class LRUStore(MutableMapping):
+    """
+    Dict-like store that evicts the least recently used entry once full.
+
+    Reads move the key to the most-recently-used end, writes past capacity
+    drop the oldest entry and report it through `on_evict` so related stores
+    can be pruned together. With a `ttl`, entries not read or written for that
+    many seconds expire as well (reported the same way). Deleted and cleared
+    keys are reported too. Every access takes the lock and drops expired
+    entries first, so `len()` and membership never count them.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        on_evict: Optional[Callable[[str], None]] = None,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        # key -> (expires_at, value), ordered least to most recently used
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._capacity = capacity
+        self._on_evict = on_evict
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def _expires_at(self) -> float:
+        return self._clock() + self._ttl if self._ttl else float("inf")
+
+    def _pop_expired(self) -> List[str]:
+        """Drop expired entries; call with the lock held."""
+        # Every access refreshes the deadline and moves the key to the end,
+        # so deadlines are in order and expired entries sit at the front
+        expired = []
+        now = self._clock()
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            expired.append(key)
+        return expired
+
+    def _report(self, evicted: List[str]) -> None:
+        if self._on_evict:
+            for evicted_key in evicted:
+                self._on_evict(evicted_key)
+
+    def __getitem__(self, key: str) -> Any:
+        with self._lock:
+            evicted = self._pop_expired()
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data[key] = (self._expires_at(), entry[1])
+                self._data.move_to_end(key)
+        self._report(evicted)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        with self._lock:
+            evicted = self._pop_expired()
+            self._data[key] = (self._expires_at(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._capacity:
+                evicted.append(self._data.popitem(last=False)[0])
+        self._report(evicted)
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            evicted = self._pop_expired()
+            found = self._data.pop(key, None) is not None
+            if found:
+                evicted.append(key)
+        self._report(evicted)
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            evicted = self._pop_expired()
+            found = key in self._data
+        self._report(evicted)
+        return found
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            evicted = self._pop_expired()
+            keys = list(self._data)
+        self._report(evicted)
+        return iter(keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            evicted = self._pop_expired()
+            size = len(self._data)
+        self._report(evicted)
+        return size
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = list(self._data)
+            self._data.clear()
+        self._report(evicted)
+
+
+# Store session IDs for conversation continuity (instead of client instances).
+# Entries live exactly as long as their stored response: they are only written
+# alongside one, and dropped by the conversations store when it evicts or
+# expires that response, so the two can never disagree.
 session_ids: Dict[str, str] = {}
 
-# Store response metadata
-conversations: Dict[str, Dict[str, Any]] = {}
+# Store serialized responses; evicting a response also forgets its session ID
+conversations: LRUStore = LRUStore(
+    CONVERSATION_CACHE_SIZE,
+    on_evict=lambda response_id: session_ids.pop(response_id, None),
+    ttl=CONVERSATION_TTL_SECONDS,
+)
 
 
 # ============================================================================
 # Claude Agent SDK Integration
 # ============================================================================
 
+# Caps concurrent Claude sessions; each one holds a CLI subprocess and its
+# API connection, so unbounded concurrency just trades throughput for 429s
+claude_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CLAUDE)
+
+def _text_delta(event: Dict[str, Any]) -> Optional[str]:
+    """Extract the text from a content_block_delta stream event, if any."""
+    delta = event.get("delta", {})
+    if delta.get("type") == "text_delta":
+        return delta.get("text", "")
+    return None
+
+
+# Raw Anthropic API stream event type -> function extracting streamed text.
+# Event types not listed here are ignored.
+STREAM_TEXT_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Optional[str]]] = {
+    "content_block_delta": _text_delta,
+}
+
+
 async def create_client(
     model: str,
-    previous_response_id: Optional[str] = None,
+    resume_session_id: Optional[str] = None,
     enable_streaming: bool = False
 ) -> ClaudeSDKClient:
     """
@@ -187,17 +533,12 @@ async def create_client(
 
     Args:
         model: Model name to use
-        previous_response_id: Optional ID to continue existing conversation
+        resume_session_id: Optional Claude session ID to continue
         enable_streaming: Whether to enable partial message streaming
 
     Returns:
         ClaudeSDKClient instance
     """
-    # Check if we're continuing a conversation
-    resume_session_id = None
-    if previous_response_id and previous_response_id in session_ids:
-        resume_session_id = session_ids[previous_response_id]
-
     # Create new client for this request (always create fresh client)
     options = ClaudeAgentOptions(
         model=model,
@@ -219,45 +560,167 @@ You have access to the project's comprehensive documentation in the /docs folder
 For coding tasks, development questions, or technical assistance, provide direct and helpful responses.""",
     )
     client = ClaudeSDKClient(options=options)
-    await client.connect()
+    try:
+        await client.connect()
+    except BaseException:
+        # A connect that fails or is cancelled partway may already have
+        # spawned the CLI subprocess, so close it instead of leaking it
+        await client.disconnect()
+        raise
     return client
 
 
+# ----------------------------------------------------------------------------
+# Warm client pool
+#
+# Spawning the CLI subprocess and handshaking in connect() dominates request
+# setup, so new conversations can take a client that was connected ahead of
+# time. Clients are single-use: after a query they carry that conversation's
+# context, so they are disconnected rather than returned to the pool, and the
+# pool is topped back up in the background. Resumed conversations always get a
+# fresh client since the session to resume is only known per request.
+#
+# Only CLIENT_POOL_MODELS are pooled and their keys are fixed at import, so
+# the model names clients send can't add pools: at most
+# CLIENT_POOL_SIZE * len(_client_pool) warm clients exist at once.
+# ----------------------------------------------------------------------------
+
+_client_pool: Dict[Tuple[str, bool], Deque[Tuple[float, ClaudeSDKClient]]] = {
+    (model, enable_streaming): deque()
+    for model in CLIENT_POOL_MODELS
+    for enable_streaming in (False, True)
+}
+_pool_refills_in_flight: Dict[Tuple[str, bool], int] = dict.fromkeys(_client_pool, 0)
+_pool_tasks: Set[asyncio.Task] = set()
+
+
+async def _refill_client_pool(key: Tuple[str, bool]) -> None:
+    """Connect one warm client for `key` and add it to the pool."""
+    model, enable_streaming = key
+    try:
+        # Connecting spawns a CLI subprocess, so it takes a concurrency slot
+        # like any other session
+        async with claude_semaphore:
+            client = await create_client(model, enable_streaming=enable_streaming)
+    except Exception:
+        # Best effort: requests fall back to creating their own client
+        return
+    finally:
+        _pool_refills_in_flight[key] -= 1
+    _client_pool[key].append((time.monotonic(), client))
+
+
+def _schedule_pool_refill(key: Tuple[str, bool]) -> None:
+    """Start background connects until the pool for `key` will be full."""
+    missing = CLIENT_POOL_SIZE - len(_client_pool[key]) - _pool_refills_in_flight[key]
+    for _ in range(missing):
+        _pool_refills_in_flight[key] += 1
+        task = asyncio.create_task(_refill_client_pool(key))
+        _pool_tasks.add(task)
+        task.add_done_callback(_pool_tasks.discard)
+
+
+async def acquire_client(
+    model: str,
+    resume_session_id: Optional[str] = None,
+    enable_streaming: bool = False
+) -> ClaudeSDKClient:
+    """
+    Get a connected client for a request, from the warm pool when possible.
+
+    Falls back to create_client() when the pool is disabled, empty, the model
+    isn't in CLIENT_POOL_MODELS, or the request resumes an existing session.
+    """
+    key = (model, enable_streaming)
+    pool = _client_pool.get(key)
+    if CLIENT_POOL_SIZE <= 0 or pool is None or resume_session_id is not None:
+        return await create_client(model, resume_session_id, enable_streaming=enable_streaming)
+
+    client = pool.popleft()[1] if pool else None
+    _schedule_pool_refill(key)
+    if client is not None:
+        return client
+    return await create_client(model, resume_session_id, enable_streaming=enable_streaming)
+
+
+async def _disconnect_quietly(client: ClaudeSDKClient) -> None:
+    """Disconnect a warm client, ignoring errors so the rest still get closed."""
+    try:
+        await client.disconnect()
+    except Exception:
+        pass
+
+
+async def reap_idle_clients() -> None:
+    """Periodically disconnect warm clients idle past CLIENT_POOL_IDLE_SECONDS."""
+    # Check at least once a second so a tiny (or zero) idle limit can't spin
+    interval = max(CLIENT_POOL_IDLE_SECONDS / 2, 1)
+    while True:
+        await asyncio.sleep(interval)
+        cutoff = time.monotonic() - CLIENT_POOL_IDLE_SECONDS
+        for pool in _client_pool.values():
+            # Clients are appended as they connect, so the oldest are on the left
+            while pool and pool[0][0] < cutoff:
+                _, client = pool.popleft()
+                await _disconnect_quietly(client)
+
+
+async def drain_client_pool() -> None:
+    """Disconnect every warm client (used on shutdown)."""
+    # Let cancelled refills unwind before draining, or they could add clients
+    # to a pool that is already empty. create_client() disconnects a client
+    # whose connect is cancelled partway, so no half-started CLI is left.
+    tasks = list(_pool_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for pool in _client_pool.values():
+        while pool:
+            _, client = pool.popleft()
+            await _disconnect_quietly(client)
+
+
 async def call_claude_agent(
     user_input: str,
     model: str,
-    previous_response_id: Optional[str] = None
+    resume_session_id: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Call Claude Agent SDK and return the complete response (non-streaming).
 
     Handles both new conversations and continuing existing ones.
     """
-    client = await create_client(model, previous_response_id, enable_streaming=False)
-
-    # Send query to Claude
-    await client.query(user_input)
-
-    # Collect response
-    response_text = ""
+    # Collect response text as parts and join once at the end
+    text_parts: List[str] = []
     input_tokens = 0
     output_tokens = 0
     session_id = None
 
-    async for message in client.receive_response():
-        if isinstance(message, AssistantMessage):
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    response_text += block.text
-        elif isinstance(message, ResultMessage):
-            # Extract usage information and session ID
-            if message.usage:
-                input_tokens = message.usage.get("input_tokens", 0)
-                output_tokens = message.usage.get("output_tokens", 0)
-            session_id = message.session_id
-
-    # Disconnect client after response is complete
-    await client.disconnect()
+    async with claude_semaphore:
+        client = await acquire_client(model, resume_session_id, enable_streaming=False)
+        try:
+            # Send query to Claude
+            await client.query(user_input)
+
+            # Without include_partial_messages no StreamEvents arrive, so only
+            # the two message types we read are matched, by exact type
+            async for message in client.receive_response():
+                message_type = type(message)
+                if message_type is AssistantMessage:
+                    for block in message.content:
+                        if type(block) is TextBlock:
+                            text_parts.append(block.text)
+                elif message_type is ResultMessage:
+                    # Extract usage information and session ID
+                    if message.usage:
+                        input_tokens = message.usage.get("input_tokens", 0)
+                        output_tokens = message.usage.get("output_tokens", 0)
+                    session_id = message.session_id
+        finally:
+            # Disconnect client after response is complete
+            await client.disconnect()
+
+    response_text = "".join(text_parts)
 
     return {
         "text": response_text or "No response generated",
@@ -272,240 +735,235 @@ async def stream_claude_agent(
     model: str,
     response_id: str,
     message_id: str,
-    previous_response_id: Optional[str] = None,
+    resume_session_id: Optional[str] = None,
     store: bool = True
-) -> AsyncIterator[str]:
+) -> AsyncIterator[bytes]:
     """
     Stream Claude Agent SDK response in OpenAI Responses API SSE format.
 
     Yields SSE-formatted events following the OpenAI Responses API spec.
     """
-    client = await create_client(model, previous_response_id, enable_streaming=True)
-
-    # Send query to Claude
-    await client.query(user_input)
-
-    # Initialize tracking variables
-    sequence_number = 0
-    response_text = ""
-    input_tokens = 0
-    output_tokens = 0
-    session_id = None
-    output_index = 0
-    content_index = 0
-    created_at = int(time.time())
-
-    # Helper function to format SSE events
-    def format_sse(event_type: str, data: dict) -> str:
-        """Format data as SSE event."""
-        json_data = json.dumps(data, separators=(',', ':'))
-        return f"event: {event_type}\ndata: {json_data}\n\n"
-
-    # Send response.created event
-    initial_response = ResponseObject(
-        id=response_id,
-        created_at=created_at,
-        status="in_progress",
-        model=model,
-        output=[],
-        usage=UsageInfo(input_tokens=0, output_tokens=0, total_tokens=0),
-        store=store
-    )
-
-    yield format_sse("response.created", {
-        "type": "response.created",
-        "response": initial_response.model_dump(),
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Send response.in_progress event
-    yield format_sse("response.in_progress", {
-        "type": "response.in_progress",
-        "response": initial_response.model_dump(),
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Send response.output_item.added event
-    message_output = MessageOutput(
-        id=message_id,
-        status="completed",
-        content=[]
-    )
-
-    yield format_sse("response.output_item.added", {
-        "type": "response.output_item.added",
-        "output_index": output_index,
-        "item": message_output.model_dump(),
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Send response.content_part.added event
-    empty_content = OutputTextContent(text="")
-
-    yield format_sse("response.content_part.added", {
-        "type": "response.content_part.added",
-        "item_id": message_id,
-        "output_index": output_index,
-        "content_index": content_index,
-        "part": empty_content.model_dump(),
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Process streaming response from Claude SDK
-    # Use receive_response() to get one complete response turn (including StreamEvents)
-    # This will automatically stop after the response is complete
-    async for message in client.receive_response():
-        # Check if this is a StreamEvent by explicitly verifying it's not a known message type
-        # and has an 'event' dict attribute (more robust than duck typing)
-        is_stream_event = (
-            not isinstance(message, (AssistantMessage, ResultMessage, SystemMessage))
-            and hasattr(message, 'event')
-            and isinstance(getattr(message, 'event', None), dict)
-        )
-
-        if is_stream_event:
-            # Handle streaming events from the Claude API
-            event = message.event
-            event_type = event.get("type")
+    # Hold a concurrency slot for the whole lifetime of the stream
+    async with claude_semaphore:
+        client = await acquire_client(model, resume_session_id, enable_streaming=True)
+        next_message: Optional[asyncio.Future] = None
+        try:
+            # Send query to Claude
+            await client.query(user_input)
+
+            # Initialize tracking variables
+            sequence_number = 0
+            text_parts: List[str] = []
+            input_tokens = 0
+            output_tokens = 0
+            session_id = None
+            output_index = 0
+            content_index = 0
+            created_at = int(time.time())
+
+            # Deltas are buffered and flushed as one event per coalescing window.
+            # last_flush starts at -inf so the first token is never held back.
+            coalesce_seconds = STREAM_COALESCE_MS / 1000
+            pending_deltas: List[str] = []
+            pending_chars = 0
+            last_flush = float("-inf")
+
+            # While text is buffered the next message is awaited as a task, so
+            # the window can run out (and the buffer be flushed) without
+            # cancelling the SDK's stream mid-read
+            messages = aiter(client.receive_response())
+
+            def delta_frame(delta_text: str, sequence_number: int) -> bytes:
+                return format_delta_sse(
+                    message_id, output_index, content_index, delta_text, sequence_number
+                )
 
-            if event_type == "content_block_delta":
-                # Extract text delta from streaming event
-                delta = event.get("delta", {})
-                if delta.get("type") == "text_delta":
-                    delta_text = delta.get("text", "")
-                    if delta_text:
-                        response_text += delta_text
-
-                        yield format_sse("response.output_text.delta", {
-                            "type": "response.output_text.delta",
-                            "item_id": message_id,
-                            "output_index": output_index,
-                            "content_index": content_index,
-                            "delta": delta_text,
-                            "sequence_number": sequence_number
-                        })
+            # Send response.created, response.in_progress,
+            # response.output_item.added and response.content_part.added events
+            yield opening_sse_frames(response_id, message_id, model, created_at, store)
+            sequence_number += 4
+
+            # Process streaming response from Claude SDK
+            # Use receive_response() to get one complete response turn (including StreamEvents)
+            # This will automatically stop after the response is complete
+            while True:
+                if pending_deltas:
+                    if next_message is None:
+                        next_message = asyncio.ensure_future(anext(messages))
+                    remaining = last_flush + coalesce_seconds - time.monotonic()
+                    done, _ = await asyncio.wait((next_message,), timeout=max(remaining, 0))
+                    if not done:
+                        # Window ran out before the next message: flush on time
+                        yield delta_frame("".join(pending_deltas), sequence_number)
                         sequence_number += 1
+                        pending_deltas.clear()
+                        pending_chars = 0
+                        last_flush = time.monotonic()
+                        continue
+                if next_message is not None:
+                    # Still pending after a timed flush, or already done
+                    arrived, next_message = next_message, None
+                    try:
+                        message = await arrived
+                    except StopAsyncIteration:
+                        break
+                else:
+                    try:
+                        message = await anext(messages)
+                    except StopAsyncIteration:
+                        break
+
+                # StreamEvents arrive once per token, so check for them first with an
+                # exact type comparison and dispatch on the raw event type
+                if type(message) is StreamEvent:
+                    event = message.event
+                    handler = STREAM_TEXT_HANDLERS.get(event.get("type"))
+                    delta_text = handler(event) if handler is not None else None
+                    if delta_text:
+                        text_parts.append(delta_text)
+                        pending_deltas.append(delta_text)
+                        pending_chars += len(delta_text)
+
+                        now = time.monotonic()
+                        if (
+                            pending_chars >= STREAM_COALESCE_CHARS
+                            or now - last_flush >= coalesce_seconds
+                        ):
+                            yield delta_frame("".join(pending_deltas), sequence_number)
+                            sequence_number += 1
+                            pending_deltas.clear()
+                            pending_chars = 0
+                            last_flush = now
+                        continue
+
+                # Anything other than a text delta marks a boundary (block
+                # start/stop, tool input, finished message, result), so don't
+                # hold buffered text back past it
+                if pending_deltas:
+                    yield delta_frame("".join(pending_deltas), sequence_number)
+                    sequence_number += 1
+                    pending_deltas.clear()
+                    pending_chars = 0
+                    last_flush = time.monotonic()
+
+                message_type = type(message)
+                if message_type is AssistantMessage:
+                    # Collect final text from AssistantMessage (fallback for non-streaming or final message)
+                    for block in message.content:
+                        if type(block) is TextBlock:
+                            # Only use this if we haven't accumulated text from deltas
+                            if not text_parts:
+                                text_parts.append(block.text)
+
+                elif message_type is ResultMessage:
+                    # Extract usage information and session ID
+                    if message.usage:
+                        input_tokens = message.usage.get("input_tokens", 0)
+                        output_tokens = message.usage.get("output_tokens", 0)
+                    session_id = message.session_id
+                    # Don't break yet - there might be more messages after tool execution
+                    # Only break when the iteration naturally completes
+
+            # Flush any text still buffered when the stream ends
+            if pending_deltas:
+                yield delta_frame("".join(pending_deltas), sequence_number)
+                sequence_number += 1
+
+            response_text = "".join(text_parts)
+
+            # Send response.output_text.done event
+            yield format_sse("response.output_text.done", ResponseOutputTextDoneEvent(
+                item_id=message_id,
+                output_index=output_index,
+                content_index=content_index,
+                text=response_text,
+                sequence_number=sequence_number
+            ))
+            sequence_number += 1
+
+            # Send response.content_part.done event
+            final_content = OutputTextContent(text=response_text)
+
+            yield format_sse("response.content_part.done", ResponseContentPartDoneEvent(
+                item_id=message_id,
+                output_index=output_index,
+                content_index=content_index,
+                part=final_content,
+                sequence_number=sequence_number
+            ))
+            sequence_number += 1
+
+            # Send response.output_item.done event
+            completed_message = MessageOutput(
+                id=message_id,
+                status="completed",
+                content=[final_content]
+            )
 
-        elif isinstance(message, AssistantMessage):
-            # Collect final text from AssistantMessage (fallback for non-streaming or final message)
-            for block in message.content:
-                if isinstance(block, TextBlock):
-                    # Only use this if we haven't accumulated text from deltas
-                    if not response_text:
-                        response_text = block.text
-
-        elif isinstance(message, ResultMessage):
-            # Extract usage information and session ID
-            if message.usage:
-                input_tokens = message.usage.get("input_tokens", 0)
-                output_tokens = message.usage.get("output_tokens", 0)
-            session_id = message.session_id
-            # Don't break yet - there might be more messages after tool execution
-            # Only break when the iteration naturally completes
-
-    # Send response.output_text.done event
-    yield format_sse("response.output_text.done", {
-        "type": "response.output_text.done",
-        "item_id": message_id,
-        "output_index": output_index,
-        "content_index": content_index,
-        "text": response_text,
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Send response.content_part.done event
-    final_content = OutputTextContent(text=response_text)
-
-    yield format_sse("response.content_part.done", {
-        "type": "response.content_part.done",
-        "item_id": message_id,
-        "output_index": output_index,
-        "content_index": content_index,
-        "part": final_content.model_dump(),
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Send response.output_item.done event
-    completed_message = MessageOutput(
-        id=message_id,
-        status="completed",
-        content=[final_content]
-    )
-
-    yield format_sse("response.output_item.done", {
-        "type": "response.output_item.done",
-        "output_index": output_index,
-        "item": completed_message.model_dump(),
-        "sequence_number": sequence_number
-    })
-    sequence_number += 1
-
-    # Send response.completed event with full response
-    final_response = ResponseObject(
-        id=response_id,
-        created_at=created_at,
-        status="completed",
-        model=model,
-        output=[completed_message],
-        usage=UsageInfo(
-            input_tokens=input_tokens,
-            output_tokens=output_tokens,
-            total_tokens=input_tokens + output_tokens
-        ),
-        store=store
-    )
-
-    yield format_sse("response.completed", {
-        "type": "response.completed",
-        "response": final_response.model_dump(),
-        "sequence_number": sequence_number
-    })
+            yield format_sse("response.output_item.done", ResponseOutputItemDoneEvent(
+                output_index=output_index,
+                item=completed_message,
+                sequence_number=sequence_number
+            ))
+            sequence_number += 1
+
+            # Send response.completed event with full response. The same bytes
+            # feed the response.completed frame and the conversation store.
+            final_json = completed_response_json(
+                response_id, created_at, model, completed_message,
+                input_tokens, output_tokens, store
+            )
 
-    # Store conversation if requested
-    if store:
-        # Store session ID for conversation continuity (not the client instance)
-        if session_id:
-            session_ids[response_id] = session_id
+            yield sse_frame("response.completed", (
+                b'{"type":"response.completed","sequence_number":%d,"response":'
+                % sequence_number + final_json + b"}"
+            ))
 
-        conversations[response_id] = {
-            "request": {
-                "model": model,
-                "input": user_input,
-                "previous_response_id": previous_response_id
-            },
-            "response": final_response.model_dump()
-        }
+            # Store conversation if requested
+            if store:
+                # Store session ID for conversation continuity (not the client instance)
+                if session_id:
+                    session_ids[response_id] = session_id
 
-    # Disconnect client after streaming is complete
-    await client.disconnect()
+                conversations[response_id] = {"response": final_json}
+        finally:
+            # Disconnect client after streaming is complete (or the caller went away)
+            if next_message is not None:
+                next_message.cancel()
+            await client.disconnect()
 
 
 # ============================================================================
 # API Endpoints
 # ============================================================================
 
-@app.post("/v1/responses")
-async def create_response(request: CreateResponseRequest):
+# Handlers return pre-serialized bytes, so response_model stays off to keep
+# FastAPI from re-validating them; responses= still documents the body shape
+@app.post(
+    "/v1/responses",
+    response_model=None,
+    responses={200: {"model": ResponseObject}},
+)
+async def create_response(request: CreateResponseRequest) -> Response:
     """
     Create a model response using Claude Agent SDK.
     Compatible with OpenAI's /v1/responses API.
 
     Supports both streaming (SSE) and non-streaming responses.
     """
-    # Generate unique IDs
-    response_id = f"resp_{uuid.uuid4().hex}"
-    message_id = f"msg_{uuid.uuid4().hex}"
-
-    # Validate previous_response_id if provided
+    # Generate unique IDs (128 random bits each) from a single urandom read
+    random_hex = secrets.token_hex(32)
+    response_id = f"resp_{random_hex[:32]}"
+    message_id = f"msg_{random_hex[32:]}"
+
+    # Validate previous_response_id and resolve its session once, up front,
+    # since the stored entry may expire before the agent runs. The read
+    # refreshes the entry, and session IDs are only dropped along with it.
+    resume_session_id = None
     if request.previous_response_id:
-        if request.previous_response_id not in conversations:
+        if conversations.get(request.previous_response_id) is None:
             raise HTTPException(status_code=404, detail="Previous response not found")
+        resume_session_id = session_ids.get(request.previous_response_id)
 
     # Handle streaming vs non-streaming
     if request.stream:
@@ -516,7 +974,7 @@ async def create_response(request: CreateResponseRequest):
                 model=request.model,
                 response_id=response_id,
                 message_id=message_id,
-                previous_response_id=request.previous_response_id,
+                resume_session_id=resume_session_id,
                 store=request.store
             ),
             media_type="text/event-stream",
@@ -532,7 +990,7 @@ async def create_response(request: CreateResponseRequest):
             result = await call_claude_agent(
                 user_input=request.input,
                 model=request.model,
-                previous_response_id=request.previous_response_id
+                resume_session_id=resume_session_id
             )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Claude Agent error: {str(e)}")
@@ -561,30 +1019,38 @@ async def create_response(request: CreateResponseRequest):
             store=request.store
         )
 
+        # Serialize once with pydantic-core and reuse the bytes for both the
+        # stored copy and the response body, skipping FastAPI's
+        # jsonable_encoder pass and response_model validation
+        response_json = response.model_dump_json().encode()
+
         # Store conversation session ID and metadata
         if request.store:
             # Store the session ID for future conversation continuity
             if result["session_id"]:
                 session_ids[response_id] = result["session_id"]
 
-            conversations[response_id] = {
-                "request": request.model_dump(),
-                "response": response.model_dump()
-            }
+            conversations[response_id] = {"response": response_json}
 
-        return response
+        return Response(content=response_json, media_type="application/json")
 
 
-@app.get("/v1/responses/{response_id}")
-async def get_response(response_id: str) -> ResponseObject:
+@app.get(
+    "/v1/responses/{response_id}",
+    response_model=None,
+    responses={200: {"model": ResponseObject}},
+)
+async def get_response(response_id: str) -> Response:
     """
     Retrieve a stored response by ID.
     """
-    if response_id not in conversations:
+    # One lookup, so an entry expiring between a check and a read can't 500
+    entry = conversations.get(response_id)
+    if entry is None:
         raise HTTPException(status_code=404, detail="Response not found")
 
-    stored = conversations[response_id]["response"]
-    return ResponseObject(**stored)
+    # Stored responses are already serialized JSON, so return them as-is
+    return Response(content=entry["response"], media_type="application/json")
 
 
 @app.get("/health")
@@ -596,4 +1062,15 @@ async def health_check():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # "auto" picks uvloop when it is installed (it isn't available on Windows);
+    # per-request access logging is off since it sits on the hot path.
+    # Uvicorn serves HTTP/1.1 only (it has no HTTP/2 support), so clients
+    # such as test_multi_turn.py reuse connections through keep-alive.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="httptools",
+        access_log=False,
+    )
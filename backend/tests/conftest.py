@@ -1,14 +1,24 @@
 """Shared test fixtures and configuration."""
 import pytest
-from unittest.mock import AsyncMock, MagicMock
+import pytest_asyncio
+from unittest.mock import AsyncMock
 from httpx import AsyncClient, ASGITransport
 from .test_config import DEFAULT_MODEL
-from main import app, session_ids, conversations
+from main import (
+    app,
+    session_ids,
+    conversations,
+    OutputTextContent,
+    MessageOutput,
+    UsageInfo,
+    ResponseObject,
+)
 from claude_agent_sdk import (
     AssistantMessage,
     TextBlock,
     ResultMessage,
 )
+from claude_agent_sdk.types import StreamEvent
 
 
 @pytest.fixture
@@ -24,53 +34,101 @@ def mock_claude_client():
 @pytest.fixture
 def mock_assistant_message():
     """Create a mock AssistantMessage."""
-    msg = MagicMock(spec=AssistantMessage)
-    msg.content = [TextBlock(text="Hello! I'm Claude, an AI assistant.")]
+    msg = AssistantMessage(
+        content=[TextBlock(text="Hello! I'm Claude, an AI assistant.")],
+        model=DEFAULT_MODEL
+    )
     return msg
 
 
 @pytest.fixture
 def mock_result_message():
     """Create a mock ResultMessage."""
-    msg = MagicMock(spec=ResultMessage)
-    msg.usage = {"input_tokens": 10, "output_tokens": 20}
-    msg.session_id = "test_session_123"
+    msg = ResultMessage(
+        subtype="success",
+        duration_ms=0,
+        duration_api_ms=0,
+        is_error=False,
+        num_turns=1,
+        session_id="test_session_123",
+        usage={"input_tokens": 10, "output_tokens": 20}
+    )
     return msg
 
 
 @pytest.fixture
 def mock_stream_event():
     """Create a mock streaming event."""
-    event = MagicMock()
-    event.event = {
-        "type": "content_block_delta",
-        "delta": {
-            "type": "text_delta",
-            "text": "Hello"
+    return StreamEvent(
+        uuid="evt_123",
+        session_id="test_session_123",
+        event={
+            "type": "content_block_delta",
+            "delta": {
+                "type": "text_delta",
+                "text": "Hello"
+            }
         }
-    }
-    # Make it not match known message types
-    type(event).__name__ = "StreamEvent"
-    return event
+    )
+
+
+@pytest.fixture(scope="session")
+def _agent_mock():
+    """The call_claude_agent stand-in, built once per session."""
+    return AsyncMock()
 
 
 @pytest.fixture
-async def test_client():
-    """Create a test client for the FastAPI app."""
-    # Clear conversation storage before each test
+def mock_agent(_agent_mock, monkeypatch):
+    """
+    Patch call_claude_agent for endpoint tests; set return_value per test.
+
+    Only the mock is shared across the session. The patch itself is applied
+    per test, since leaving it in place would also replace call_claude_agent
+    for the tests that exercise the real one through the endpoints.
+    """
+    _agent_mock.reset_mock(return_value=True, side_effect=True)
+    monkeypatch.setattr("main.call_claude_agent", _agent_mock)
+    return _agent_mock
+
+
+@pytest.fixture(autouse=True)
+def _reset_state():
+    """Clear conversation storage before each test."""
     session_ids.clear()
     conversations.clear()
 
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def _client():
+    """
+    One AsyncClient for the whole test session.
+
+    raise_app_exceptions=False turns unhandled app errors into 500 responses
+    instead of raising them through the shared transport.
+    """
     async with AsyncClient(
-        transport=ASGITransport(app=app),
-        base_url="http://test"
+        transport=ASGITransport(app=app, raise_app_exceptions=False),
+        base_url="http://test",
+        timeout=30
     ) as client:
         yield client
 
 
 @pytest.fixture
+def test_client(_client):
+    """Create a test client for the FastAPI app."""
+    return _client
+
+
+@pytest.fixture(scope="session")
 def sample_request_data():
-    """Sample request data for testing."""
+    """
+    Sample request data for testing.
+
+    Shared across the session, so tests must build variations with
+    {**sample_request_data, ...} rather than mutating it.
+    """
     return {
         "model": DEFAULT_MODEL,
         "input": "Hello, how are you?",
@@ -88,3 +146,47 @@ def sample_response_data():
         "output_tokens": 20,
         "session_id": "test_session_123"
     }
+
+
+# Canonical model instances, built once per session. Freezing the models only
+# blocks attribute assignment: their lists and the metadata dict are still
+# mutable, so tests must not modify them in place. Use
+# model_copy(update={...}) for variations.
+
+@pytest.fixture(scope="session")
+def sample_content():
+    """OutputTextContent with text "Test"."""
+    return OutputTextContent(text="Test")
+
+
+@pytest.fixture(scope="session")
+def sample_message(sample_content):
+    """
+    MessageOutput "msg_123" holding sample_content.
+
+    Shared across the session, so tests must not mutate its content list.
+    """
+    return MessageOutput(id="msg_123", content=[sample_content])
+
+
+@pytest.fixture(scope="session")
+def sample_usage():
+    """UsageInfo with one input and one output token."""
+    return UsageInfo(input_tokens=1, output_tokens=1, total_tokens=2)
+
+
+@pytest.fixture(scope="session")
+def sample_response(sample_message, sample_usage):
+    """
+    ResponseObject "resp_123" wrapping sample_message and sample_usage.
+
+    Shared across the session, so tests must not mutate its output list or
+    metadata dict; build variations with model_copy(update={...}).
+    """
+    return ResponseObject(
+        id="resp_123",
+        created_at=1234567890,
+        model=DEFAULT_MODEL,
+        output=[sample_message],
+        usage=sample_usage
+    )
@@ -0,0 +1,94 @@
+"""Shared helpers for mocking Claude SDK responses and reading SSE output in tests."""
+import re
+from collections import Counter
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+import orjson
+from claude_agent_sdk import AssistantMessage, TextBlock, ResultMessage
+from claude_agent_sdk.types import StreamEvent
+from .test_config import DEFAULT_MODEL
+
+
+def make_stream(
+    deltas: Sequence[str] = (),
+    texts: Sequence[str] = (),
+    usage: Optional[Dict[str, Any]] = None,
+    session_id: str = "test_session",
+) -> Callable[[], AsyncIterator[Any]]:
+    """
+    Build a replacement for ClaudeSDKClient.receive_response.
+
+    Yields a StreamEvent per delta, an AssistantMessage with one TextBlock per
+    entry in `texts` (omitted when empty), then a ResultMessage. The messages
+    are built once; each call just iterates over them.
+    """
+    messages = [
+        StreamEvent(
+            uuid=f"evt_{index}",
+            session_id=session_id,
+            event={
+                "type": "content_block_delta",
+                "delta": {"type": "text_delta", "text": text}
+            }
+        )
+        for index, text in enumerate(deltas)
+    ]
+    if texts:
+        messages.append(AssistantMessage(
+            content=[TextBlock(text=text) for text in texts],
+            model=DEFAULT_MODEL
+        ))
+    messages.append(ResultMessage(
+        subtype="success",
+        duration_ms=0,
+        duration_api_ms=0,
+        is_error=False,
+        num_turns=1,
+        session_id=session_id,
+        usage=usage if usage is not None else {"input_tokens": 0, "output_tokens": 0}
+    ))
+    messages = tuple(messages)
+
+    async def receive_response():
+        for message in messages:
+            yield message
+
+    return receive_response
+
+
+class StubClient:
+    """
+    Minimal stand-in for ClaudeSDKClient.
+
+    Records the prompts passed to query() and whether disconnect() was
+    awaited, for tests that don't need AsyncMock's call tracking.
+    """
+
+    def __init__(self, receive_response: Callable[[], AsyncIterator[Any]]):
+        self.receive_response = receive_response
+        self.query_calls: List[str] = []
+        self.disconnected = False
+
+    async def connect(self) -> None:
+        pass
+
+    async def query(self, prompt: str) -> None:
+        self.query_calls.append(prompt)
+
+    async def disconnect(self) -> None:
+        self.disconnected = True
+
+
+_SSE_EVENT_RE = re.compile(rb"^event: (\S+)\r?\ndata: (.+)$", re.M)
+
+
+def parse_sse(content: bytes) -> List[Tuple[str, Dict[str, Any]]]:
+    """Parse an SSE response body into (event type, decoded data) pairs."""
+    return [
+        (match.group(1).decode(), orjson.loads(match.group(2)))
+        for match in _SSE_EVENT_RE.finditer(content)
+    ]
+
+
+def sse_event_types(content: bytes) -> Counter:
+    """Count the events of each type in an SSE response body in one pass."""
+    return Counter(match.group(1).decode() for match in _SSE_EVENT_RE.finditer(content))
@@ -1,9 +1,16 @@
 """Integration tests for API endpoints."""
+import asyncio
 import pytest
-from unittest.mock import patch, AsyncMock, MagicMock
+from unittest.mock import patch, AsyncMock
 from .test_config import DEFAULT_MODEL
-from main import session_ids, conversations
-from claude_agent_sdk import AssistantMessage, TextBlock, ResultMessage
+from main import (
+    session_ids,
+    conversations,
+    ResponseCreatedEvent,
+    ResponseInProgressEvent,
+    ResponseCompletedEvent,
+)
+from .helpers import StubClient, make_stream, parse_sse, sse_event_types
 
 
 @pytest.mark.integration
@@ -19,6 +26,49 @@ class TestHealthEndpoint:
         assert data["service"] == "claude-agent-api"
 
 
+@pytest.mark.integration
+class TestCORS:
+    """Test CORS origin matching."""
+
+    @pytest.mark.parametrize("origin,allowed", [
+        ("http://localhost:5173", True),
+        ("http://localhost:3000", True),
+        ("http://localhost:8080", False),
+        ("http://localhost:5173.evil.com", False),
+    ])
+    async def test_preflight_origin(self, test_client, origin, allowed):
+        """Test that only the dev server origins pass a CORS preflight."""
+        response = await test_client.options(
+            "/v1/responses",
+            headers={
+                "Origin": origin,
+                "Access-Control-Request-Method": "POST",
+            }
+        )
+
+        assert (response.status_code == 200) == allowed
+        assert (response.headers.get("access-control-allow-origin") == origin) == allowed
+
+
+@pytest.mark.integration
+class TestOpenAPISchema:
+    """Test the generated OpenAPI document."""
+
+    @pytest.mark.parametrize("path,method", [
+        ("/v1/responses", "post"),
+        ("/v1/responses/{response_id}", "get"),
+    ])
+    async def test_response_schema_documented(self, test_client, path, method):
+        """Test that the fast-path routes still document ResponseObject."""
+        response = await test_client.get("/openapi.json")
+        assert response.status_code == 200
+
+        content = response.json()["paths"][path][method]["responses"]["200"]["content"]
+        assert content["application/json"]["schema"] == {
+            "$ref": "#/components/schemas/ResponseObject"
+        }
+
+
 @pytest.mark.integration
 class TestCreateResponseEndpoint:
     """Test /v1/responses endpoint."""
@@ -92,9 +142,9 @@ class TestCreateResponseEndpoint:
     ):
         """Test that conversation is not stored when store=False."""
         mock_call_agent.return_value = sample_response_data
-        sample_request_data["store"] = False
+        request_data = {**sample_request_data, "store": False}
 
-        response = await test_client.post("/v1/responses", json=sample_request_data)
+        response = await test_client.post("/v1/responses", json=request_data)
 
         assert response.status_code == 200
         data = response.json()
@@ -120,13 +170,17 @@ class TestCreateResponseEndpoint:
         first_id = first_data["id"]
 
         # Now create a follow-up response
-        followup_data = sample_response_data.copy()
-        followup_data["text"] = "This is a follow-up response."
+        followup_data = {
+            **sample_response_data,
+            "text": "This is a follow-up response.",
+        }
         mock_call_agent.return_value = followup_data
 
-        followup_request = sample_request_data.copy()
-        followup_request["input"] = "What did we talk about?"
-        followup_request["previous_response_id"] = first_id
+        followup_request = {
+            **sample_request_data,
+            "input": "What did we talk about?",
+            "previous_response_id": first_id,
+        }
 
         response = await test_client.post("/v1/responses", json=followup_request)
 
@@ -134,18 +188,18 @@ class TestCreateResponseEndpoint:
         data = response.json()
         assert data["output"][0]["content"][0]["text"] == "This is a follow-up response."
 
-        # Verify call_claude_agent was called with previous_response_id
+        # Verify call_claude_agent resumed the first response's session
         mock_call_agent.assert_called_with(
             user_input="What did we talk about?",
             model=sample_request_data["model"],
-            previous_response_id=first_id
+            resume_session_id=sample_response_data["session_id"]
         )
 
     async def test_invalid_previous_response_id(self, test_client, sample_request_data):
         """Test error handling for invalid previous_response_id."""
-        sample_request_data["previous_response_id"] = "resp_nonexistent"
+        request_data = {**sample_request_data, "previous_response_id": "resp_nonexistent"}
 
-        response = await test_client.post("/v1/responses", json=sample_request_data)
+        response = await test_client.post("/v1/responses", json=request_data)
 
         assert response.status_code == 404
         data = response.json()
@@ -153,17 +207,13 @@ class TestCreateResponseEndpoint:
 
     async def test_missing_required_fields(self, test_client):
         """Test validation error for missing required fields."""
-        # Missing 'input' field
-        response = await test_client.post("/v1/responses", json={
-            "model": DEFAULT_MODEL
-        })
-        assert response.status_code == 422
+        missing_input, missing_model = await asyncio.gather(
+            test_client.post("/v1/responses", json={"model": DEFAULT_MODEL}),
+            test_client.post("/v1/responses", json={"input": "Hello!"}),
+        )
 
-        # Missing 'model' field
-        response = await test_client.post("/v1/responses", json={
-            "input": "Hello!"
-        })
-        assert response.status_code == 422
+        assert missing_input.status_code == 422
+        assert missing_model.status_code == 422
 
     @patch("main.call_claude_agent")
     async def test_agent_error_handling(
@@ -213,6 +263,40 @@ class TestGetResponseEndpoint:
         assert retrieved_data["model"] == created_data["model"]
         assert retrieved_data["output"] == created_data["output"]
 
+    @patch("main.ClaudeSDKClient")
+    async def test_get_keeps_conversation_resumable(
+        self,
+        mock_client_class,
+        test_client,
+        sample_request_data,
+        monkeypatch
+    ):
+        """Test that a GET partway through the TTL keeps the session resumable."""
+        now = 0.0
+        # Session IDs are dropped along with their response, so only the
+        # conversations store needs the fake clock
+        monkeypatch.setattr(conversations, "_ttl", 60)
+        monkeypatch.setattr(conversations, "_clock", lambda: now)
+        mock_client_class.side_effect = lambda options: StubClient(make_stream(
+            texts=["Hi"], session_id="session_ttl"
+        ))
+
+        first = await test_client.post("/v1/responses", json=sample_request_data)
+        first_id = first.json()["id"]
+
+        # Reading the response refreshes its deadline...
+        now = 50.0
+        assert (await test_client.get(f"/v1/responses/{first_id}")).status_code == 200
+
+        # ...so a continuation past the original deadline still resumes
+        now = 100.0
+        followup = await test_client.post("/v1/responses", json={
+            **sample_request_data, "previous_response_id": first_id
+        })
+
+        assert followup.status_code == 200
+        assert mock_client_class.call_args.kwargs["options"].resume == "session_ttl"
+
     async def test_get_nonexistent_response(self, test_client):
         """Test retrieving a non-existent response."""
         response = await test_client.get("/v1/responses/resp_nonexistent")
@@ -240,45 +324,22 @@ class TestStreamingResponse:
         mock_client.disconnect = AsyncMock()
 
         # Mock streaming response
-        async def mock_receive():
-            # Yield a stream event
-            stream_event = MagicMock()
-            stream_event.event = {
-                "type": "content_block_delta",
-                "delta": {"type": "text_delta", "text": "Hello"}
-            }
-            type(stream_event).__name__ = "StreamEvent"
-            yield stream_event
-
-            # Yield assistant message
-            msg = MagicMock(spec=AssistantMessage)
-            msg.content = [TextBlock(text="Hello")]
-            yield msg
-
-            # Yield result message
-            result_msg = MagicMock(spec=ResultMessage)
-            result_msg.usage = {"input_tokens": 10, "output_tokens": 5}
-            result_msg.session_id = "test_session"
-            yield result_msg
-
-        mock_client.receive_response = mock_receive
+        mock_client.receive_response = make_stream(
+            deltas=["Hello"],
+            texts=["Hello"],
+            usage={"input_tokens": 10, "output_tokens": 5},
+            session_id="test_session",
+        )
         mock_create_client.return_value = mock_client
 
         # Enable streaming
-        sample_request_data["stream"] = True
-
-        response = await test_client.post("/v1/responses", json=sample_request_data)
+        request_data = {**sample_request_data, "stream": True}
 
+        response = await test_client.post("/v1/responses", json=request_data)
         assert response.status_code == 200
         assert response.headers["content-type"] == "text/event-stream; charset=utf-8"
 
-        # Parse SSE events
-        content = response.text
-        events = []
-        for line in content.split("\n\n"):
-            if line.startswith("event:"):
-                event_type = line.split("\n")[0].replace("event: ", "").strip()
-                events.append(event_type)
+        events = sse_event_types(response.content)
 
         # Verify expected events
         assert "response.created" in events
@@ -301,35 +362,90 @@ class TestStreamingResponse:
         mock_client.query = AsyncMock()
         mock_client.disconnect = AsyncMock()
 
-        async def mock_receive():
-            msg = MagicMock(spec=AssistantMessage)
-            msg.content = [TextBlock(text="Streaming response")]
-            yield msg
+        mock_client.receive_response = make_stream(
+            texts=["Streaming response"],
+            usage={"input_tokens": 10, "output_tokens": 15},
+            session_id="stream_session_123",
+        )
+        mock_create_client.return_value = mock_client
+
+        request_data = {**sample_request_data, "stream": True}
+
+        response = await test_client.post("/v1/responses", json=request_data)
+        assert response.status_code == 200
+
+        # Take the response ID from the response.created event
+        event_type, data = parse_sse(response.content)[0]
+        assert event_type == "response.created"
+        response_id = data["response"]["id"]
 
-            result_msg = MagicMock(spec=ResultMessage)
-            result_msg.usage = {"input_tokens": 10, "output_tokens": 15}
-            result_msg.session_id = "stream_session_123"
-            yield result_msg
+        # Storage happens once the stream has completed
+        assert response_id in conversations
+        assert response_id in session_ids
+
+    @patch("main.create_client")
+    async def test_streaming_initial_events_are_valid(
+        self,
+        mock_create_client,
+        test_client,
+        sample_request_data
+    ):
+        """Test that response.created/in_progress frames match their models."""
+        mock_client = AsyncMock()
+        mock_client.query = AsyncMock()
+        mock_client.disconnect = AsyncMock()
 
-        mock_client.receive_response = mock_receive
+        mock_client.receive_response = make_stream(
+            usage={"input_tokens": 1, "output_tokens": 1},
+            session_id="initial_session",
+        )
         mock_create_client.return_value = mock_client
 
-        sample_request_data["stream"] = True
+        request_data = {**sample_request_data, "stream": True}
 
-        response = await test_client.post("/v1/responses", json=sample_request_data)
+        response = await test_client.post("/v1/responses", json=request_data)
+        assert response.status_code == 200
+
+        events = parse_sse(response.content)
+        created = ResponseCreatedEvent.model_validate(events[0][1])
+        in_progress = ResponseInProgressEvent.model_validate(events[1][1])
+
+        assert created.sequence_number == 0
+        assert in_progress.sequence_number == 1
+        assert created.response == in_progress.response
+        assert created.response.status == "in_progress"
+        assert created.response.model == sample_request_data["model"]
 
+    @patch("main.create_client")
+    async def test_streaming_completed_event_matches_stored_response(
+        self,
+        mock_create_client,
+        test_client,
+        sample_request_data
+    ):
+        """Test that response.completed carries the same response that is stored."""
+        mock_client = AsyncMock()
+        mock_client.query = AsyncMock()
+        mock_client.disconnect = AsyncMock()
+
+        mock_client.receive_response = make_stream(
+            texts=["Stored text"],
+            usage={"input_tokens": 3, "output_tokens": 4},
+            session_id="completed_session",
+        )
+        mock_create_client.return_value = mock_client
+
+        request_data = {**sample_request_data, "stream": True}
+
+        response = await test_client.post("/v1/responses", json=request_data)
         assert response.status_code == 200
 
-        # Extract response ID from the SSE events
-        content = response.text
-        # Look for response.created event to get the response ID
-        import json
-        for line in content.split("\n"):
-            if line.startswith("data:"):
-                data = json.loads(line.replace("data: ", ""))
-                if data.get("type") == "response.created":
-                    response_id = data["response"]["id"]
-                    # Verify it was stored
-                    assert response_id in conversations
-                    assert response_id in session_ids
-                    break
+        completed = ResponseCompletedEvent.model_validate(parse_sse(response.content)[-1][1])
+
+        assert completed.response.status == "completed"
+        assert completed.response.output[0].content[0].text == "Stored text"
+        assert completed.response.usage.total_tokens == 7
+
+        get_response = await test_client.get(f"/v1/responses/{completed.response.id}")
+        assert get_response.status_code == 200
+        assert get_response.json() == completed.response.model_dump()
@@ -1,18 +1,34 @@
 """Unit tests for helper functions."""
+import asyncio
+import json
 import pytest
-from unittest.mock import AsyncMock, patch, MagicMock
+from unittest.mock import AsyncMock, patch
 from .test_config import DEFAULT_MODEL
 from main import (
     create_client,
+    acquire_client,
+    drain_client_pool,
     call_claude_agent,
+    stream_claude_agent,
+    format_sse,
+    format_delta_sse,
+    opening_sse_frames,
+    completed_response_json,
+    LRUStore,
+    OutputTextContent,
+    MessageOutput,
+    UsageInfo,
+    ResponseObject,
+    ResponseCreatedEvent,
+    ResponseInProgressEvent,
+    ResponseOutputItemAddedEvent,
+    ResponseContentPartAddedEvent,
+    ResponseOutputTextDeltaEvent,
     session_ids,
     conversations,
 )
-from claude_agent_sdk import (
-    AssistantMessage,
-    TextBlock,
-    ResultMessage,
-)
+from claude_agent_sdk import ResultMessage
+from .helpers import StubClient, make_stream, parse_sse
 
 
 @pytest.mark.unit
@@ -28,7 +44,7 @@ class TestCreateClient:
 
         client = await create_client(
             model=DEFAULT_MODEL,
-            previous_response_id=None
+            resume_session_id=None
         )
 
         assert client is not None
@@ -44,16 +60,13 @@ class TestCreateClient:
     @patch("main.ClaudeSDKClient")
     async def test_create_client_with_resume(self, mock_client_class):
         """Test creating a client with previous session."""
-        # Set up a previous session
-        session_ids["resp_123"] = "session_abc"
-
         mock_instance = AsyncMock()
         mock_instance.connect = AsyncMock()
         mock_client_class.return_value = mock_instance
 
         client = await create_client(
             model=DEFAULT_MODEL,
-            previous_response_id="resp_123"
+            resume_session_id="session_abc"
         )
 
         # Verify resume was passed
@@ -61,8 +74,23 @@ class TestCreateClient:
         options = call_args.kwargs["options"]
         assert options.resume == "session_abc"
 
-        # Clean up
-        session_ids.clear()
+    @patch("main.ClaudeSDKClient")
+    async def test_cancelled_connect_disconnects(self, mock_client_class):
+        """Test that a connect cancelled partway closes the half-started client."""
+        async def hanging_connect():
+            await asyncio.sleep(60)
+
+        mock_instance = AsyncMock()
+        mock_instance.connect = AsyncMock(side_effect=hanging_connect)
+        mock_client_class.return_value = mock_instance
+
+        task = asyncio.create_task(create_client(model=DEFAULT_MODEL))
+        await asyncio.sleep(0)
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        mock_instance.disconnect.assert_awaited_once()
 
     @patch("main.ClaudeSDKClient")
     async def test_create_client_with_streaming(self, mock_client_class):
@@ -94,18 +122,13 @@ class TestCallClaudeAgent:
         mock_result_message
     ):
         """Test successful agent call."""
-        # Create mock client
-        mock_client = AsyncMock()
-        mock_client.query = AsyncMock()
-        mock_client.disconnect = AsyncMock()
-
         # Mock the response stream
         async def mock_receive():
             yield mock_assistant_message
             yield mock_result_message
 
-        mock_client.receive_response = mock_receive
-        mock_create_client.return_value = mock_client
+        stub_client = StubClient(mock_receive)
+        mock_create_client.return_value = stub_client
 
         # Call the function
         result = await call_claude_agent(
@@ -120,25 +143,17 @@ class TestCallClaudeAgent:
         assert result["session_id"] == "test_session_123"
 
         # Verify client interactions
-        mock_client.query.assert_called_once_with("Hello!")
-        mock_client.disconnect.assert_called_once()
+        assert stub_client.query_calls == ["Hello!"]
+        assert stub_client.disconnected
 
     @patch("main.create_client")
     async def test_no_text_response(self, mock_create_client):
         """Test handling when no text is returned."""
-        mock_client = AsyncMock()
-        mock_client.query = AsyncMock()
-        mock_client.disconnect = AsyncMock()
-
         # Mock empty response
-        async def mock_receive():
-            msg = MagicMock(spec=ResultMessage)
-            msg.usage = {"input_tokens": 5, "output_tokens": 0}
-            msg.session_id = "test_session"
-            yield msg
-
-        mock_client.receive_response = mock_receive
-        mock_create_client.return_value = mock_client
+        mock_create_client.return_value = StubClient(make_stream(
+            usage={"input_tokens": 5, "output_tokens": 0},
+            session_id="test_session",
+        ))
 
         result = await call_claude_agent(
             user_input="Hello!",
@@ -151,65 +166,35 @@ class TestCallClaudeAgent:
         assert result["output_tokens"] == 0
 
     @patch("main.create_client")
-    async def test_with_previous_response_id(self, mock_create_client):
-        """Test calling with previous response ID."""
-        mock_client = AsyncMock()
-        mock_client.query = AsyncMock()
-        mock_client.disconnect = AsyncMock()
-
-        async def mock_receive():
-            msg = MagicMock(spec=AssistantMessage)
-            msg.content = [TextBlock(text="Continuing conversation")]
-            yield msg
-
-            result_msg = MagicMock(spec=ResultMessage)
-            result_msg.usage = {"input_tokens": 15, "output_tokens": 25}
-            result_msg.session_id = "session_continue"
-            yield result_msg
-
-        mock_client.receive_response = mock_receive
-        mock_create_client.return_value = mock_client
+    async def test_with_resume_session_id(self, mock_create_client):
+        """Test calling with a session to resume."""
+        mock_create_client.return_value = StubClient(make_stream(
+            texts=["Continuing conversation"],
+            usage={"input_tokens": 15, "output_tokens": 25},
+            session_id="session_continue",
+        ))
 
         result = await call_claude_agent(
             user_input="What did we discuss?",
             model=DEFAULT_MODEL,
-            previous_response_id="resp_abc123"
+            resume_session_id="session_abc123"
         )
 
-        # Verify create_client was called with previous_response_id
-        mock_create_client.assert_called_once()
-        call_args = mock_create_client.call_args
-        # Check if passed as positional or keyword argument
-        if "previous_response_id" in call_args.kwargs:
-            assert call_args.kwargs["previous_response_id"] == "resp_abc123"
-        else:
-            # Should be second positional argument
-            assert call_args.args[1] == "resp_abc123"
+        # Verify create_client was asked to resume the session
+        mock_create_client.assert_called_once_with(
+            DEFAULT_MODEL, "session_abc123", enable_streaming=False
+        )
 
         assert result["text"] == "Continuing conversation"
 
     @patch("main.create_client")
     async def test_multiple_text_blocks(self, mock_create_client):
         """Test handling multiple text blocks in response."""
-        mock_client = AsyncMock()
-        mock_client.query = AsyncMock()
-        mock_client.disconnect = AsyncMock()
-
-        async def mock_receive():
-            msg = MagicMock(spec=AssistantMessage)
-            msg.content = [
-                TextBlock(text="First part. "),
-                TextBlock(text="Second part.")
-            ]
-            yield msg
-
-            result_msg = MagicMock(spec=ResultMessage)
-            result_msg.usage = {"input_tokens": 10, "output_tokens": 20}
-            result_msg.session_id = "test_session"
-            yield result_msg
-
-        mock_client.receive_response = mock_receive
-        mock_create_client.return_value = mock_client
+        mock_create_client.return_value = StubClient(make_stream(
+            texts=["First part. ", "Second part."],
+            usage={"input_tokens": 10, "output_tokens": 20},
+            session_id="test_session",
+        ))
 
         result = await call_claude_agent(
             user_input="Tell me something",
@@ -219,34 +204,432 @@ class TestCallClaudeAgent:
         # Text blocks should be concatenated
         assert result["text"] == "First part. Second part."
 
+    @patch("main.create_client")
+    async def test_disconnects_on_error(self, mock_create_client):
+        """Test that the client is disconnected even if the query fails."""
+        mock_client = AsyncMock()
+        mock_client.query = AsyncMock(side_effect=RuntimeError("boom"))
+        mock_client.disconnect = AsyncMock()
+        mock_create_client.return_value = mock_client
+
+        with pytest.raises(RuntimeError):
+            await call_claude_agent(user_input="Hello!", model=DEFAULT_MODEL)
+
+        mock_client.disconnect.assert_called_once()
+
+    @patch("main.create_client")
+    async def test_limits_concurrent_sessions(self, mock_create_client, monkeypatch):
+        """Test that concurrent calls are capped by the Claude semaphore."""
+        monkeypatch.setattr("main.claude_semaphore", asyncio.Semaphore(1))
+
+        active = 0
+        max_active = 0
+
+        def make_client():
+            async def mock_receive():
+                nonlocal active, max_active
+                active += 1
+                max_active = max(max_active, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+                msg = ResultMessage(
+                    subtype="success",
+                    duration_ms=0,
+                    duration_api_ms=0,
+                    is_error=False,
+                    num_turns=1,
+                    session_id="limited_session",
+                    usage={"input_tokens": 1, "output_tokens": 1}
+                )
+                yield msg
+
+            return StubClient(mock_receive)
+
+        mock_create_client.side_effect = lambda *args, **kwargs: make_client()
+
+        await asyncio.gather(*(
+            call_claude_agent(user_input="Hello!", model=DEFAULT_MODEL)
+            for _ in range(3)
+        ))
+
+        assert max_active == 1
+        assert mock_create_client.call_count == 3
+
+
+@pytest.mark.unit
+class TestStreamClaudeAgent:
+    """Test stream_claude_agent function."""
+
+    @patch("main.create_client")
+    async def test_flushes_buffered_delta_during_pause(self, mock_create_client, monkeypatch):
+        """Test that buffered text goes out once the window ends, not at the next message."""
+        monkeypatch.setattr("main.STREAM_COALESCE_MS", 20)
+        resume = asyncio.Event()
+        text_stream = make_stream(deltas=["Hello", " there"], session_id="pause_session")
+
+        # Stall after the deltas (as during tool use) until the test resumes it
+        async def receive_response():
+            async for message in text_stream():
+                if isinstance(message, ResultMessage):
+                    await resume.wait()
+                yield message
+
+        mock_create_client.return_value = StubClient(receive_response)
+
+        stream = stream_claude_agent(
+            user_input="Hello!",
+            model=DEFAULT_MODEL,
+            response_id="resp_pause",
+            message_id="msg_pause",
+            store=False
+        )
+
+        deltas = []
+        async with asyncio.timeout(5):
+            while deltas != ["Hello", " there"]:
+                for event_type, data in parse_sse(await anext(stream)):
+                    if event_type == "response.output_text.delta":
+                        deltas.append(data["delta"])
+
+        # " there" was sent while the SDK was still stalled
+        assert not resume.is_set()
+
+        resume.set()
+        remaining = b"".join([frame async for frame in stream])
+        assert [event_type for event_type, _ in parse_sse(remaining)][-1] == "response.completed"
+
+
+@pytest.mark.unit
+class TestFormatSSE:
+    """Test format_sse function."""
+
+    def test_formats_event_as_sse_bytes(self):
+        """Test that an event model is rendered as a complete SSE frame."""
+        event = ResponseOutputTextDeltaEvent(
+            item_id="msg_123",
+            output_index=0,
+            content_index=0,
+            delta="Hello",
+            sequence_number=4
+        )
+
+        frame = format_sse("response.output_text.delta", event)
+
+        assert isinstance(frame, bytes)
+        assert frame.startswith(b"event: response.output_text.delta\ndata: ")
+        assert frame.endswith(b"\n\n")
+
+        data = json.loads(frame.split(b"data: ", 1)[1])
+        assert data["type"] == "response.output_text.delta"
+        assert data["delta"] == "Hello"
+        assert data["sequence_number"] == 4
+
+    @pytest.mark.parametrize("delta", ["Hello", 'Quotes "and" ünïcode\n'])
+    def test_delta_matches_model_serialization(self, delta):
+        """Test that format_delta_sse matches formatting the delta event model."""
+        event = ResponseOutputTextDeltaEvent(
+            item_id="msg_123",
+            output_index=0,
+            content_index=0,
+            delta=delta,
+            sequence_number=4
+        )
+
+        frame = format_delta_sse("msg_123", 0, 0, delta, 4)
+
+        assert frame == format_sse("response.output_text.delta", event)
+
+
+@pytest.mark.unit
+class TestOpeningSSEFrames:
+    """Test opening_sse_frames templates against the event models."""
+
+    @pytest.mark.parametrize("model,store", [
+        (DEFAULT_MODEL, True),
+        ('model "with" quotes\\', False),
+        ("modèle-ünïcode", True),
+    ])
+    def test_matches_model_serialization(self, model, store):
+        """Test that the templated frames match serializing the models."""
+        initial_response = ResponseObject(
+            id="resp_abc",
+            created_at=1234567890,
+            status="in_progress",
+            model=model,
+            output=[],
+            usage=UsageInfo(input_tokens=0, output_tokens=0, total_tokens=0),
+            store=store
+        )
+        expected = b"".join([
+            format_sse("response.created", ResponseCreatedEvent(
+                response=initial_response, sequence_number=0
+            )),
+            format_sse("response.in_progress", ResponseInProgressEvent(
+                response=initial_response, sequence_number=1
+            )),
+            format_sse("response.output_item.added", ResponseOutputItemAddedEvent(
+                output_index=0,
+                item=MessageOutput(id="msg_abc", content=[]),
+                sequence_number=2
+            )),
+            format_sse("response.content_part.added", ResponseContentPartAddedEvent(
+                item_id="msg_abc",
+                output_index=0,
+                content_index=0,
+                part=OutputTextContent(text=""),
+                sequence_number=3
+            )),
+        ])
+
+        frames = opening_sse_frames("resp_abc", "msg_abc", model, 1234567890, store)
+
+        assert frames == expected
+
+
+@pytest.mark.unit
+class TestCompletedResponseJSON:
+    """Test completed_response_json against the ResponseObject model."""
+
+    @pytest.mark.parametrize("text,store", [
+        ("Hello!", True),
+        ('Quotes "and" ünïcode\n', False),
+    ])
+    def test_matches_model_serialization(self, text, store):
+        """Test that the hand-built JSON matches serializing a ResponseObject."""
+        message = MessageOutput(id="msg_abc", content=[OutputTextContent(text=text)])
+        expected = ResponseObject(
+            id="resp_abc",
+            created_at=1234567890,
+            status="completed",
+            model=DEFAULT_MODEL,
+            output=[message],
+            usage=UsageInfo(input_tokens=10, output_tokens=5, total_tokens=15),
+            store=store
+        ).model_dump_json().encode()
+
+        result = completed_response_json(
+            "resp_abc", 1234567890, DEFAULT_MODEL, message, 10, 5, store
+        )
+
+        assert result == expected
+
 
 @pytest.mark.unit
 class TestConversationStorage:
     """Test conversation storage functionality."""
 
-    def test_session_ids_storage(self):
-        """Test storing and retrieving session IDs."""
-        session_ids.clear()
+    @pytest.mark.parametrize("store,key,value", [
+        (session_ids, "resp_123", "session_abc"),
+        (conversations, "resp_123", {"response": b'{"id":"resp_123","output":[]}'}),
+    ], ids=["session_ids", "conversations"])
+    def test_store_round_trip(self, store, key, value):
+        """Test storing and retrieving entries in the conversation stores."""
+        store[key] = value
+
+        assert key in store
+        assert store[key] == value
+        assert len(store) == 1
+
+
+@pytest.mark.unit
+class TestLRUStore:
+    """Test LRUStore eviction behaviour."""
+
+    def test_evicts_least_recently_used(self):
+        """Test that the oldest untouched entry is evicted at capacity."""
+        store = LRUStore(capacity=2)
+        store["a"] = 1
+        store["b"] = 2
+
+        # Reading "a" makes "b" the least recently used entry
+        assert store["a"] == 1
+        store["c"] = 3
+
+        assert "a" in store
+        assert "b" not in store
+        assert "c" in store
+        assert len(store) == 2
+
+    def test_on_evict_callback(self):
+        """Test that evicted keys are reported to the callback."""
+        evicted = []
+        store = LRUStore(capacity=1, on_evict=evicted.append)
+
+        store["a"] = 1
+        store["b"] = 2
+
+        assert evicted == ["a"]
+
+    def test_idle_entries_expire(self):
+        """Test that entries unused for the TTL expire and are reported."""
+        now = 0.0
+        evicted = []
+        store = LRUStore(capacity=10, on_evict=evicted.append, ttl=60, clock=lambda: now)
+        store["a"] = 1
+        store["b"] = 2
+
+        # Reading "a" refreshes its deadline
+        now = 50.0
+        assert store["a"] == 1
+
+        now = 70.0
+        assert "a" in store
+        assert "b" not in store
+        assert len(store) == 1
 
-        session_ids["resp_123"] = "session_abc"
-        session_ids["resp_456"] = "session_def"
+        store["c"] = 3
+        assert evicted == ["b"]
 
-        assert session_ids["resp_123"] == "session_abc"
-        assert session_ids["resp_456"] == "session_def"
-        assert len(session_ids) == 2
+        now = 200.0
+        with pytest.raises(KeyError):
+            store["a"]
+        assert evicted == ["b", "a", "c"]
 
-        session_ids.clear()
+    def test_delete_reports_key(self):
+        """Test that deleting an entry reports it like an eviction."""
+        evicted = []
+        store = LRUStore(capacity=10, on_evict=evicted.append)
+        store["a"] = 1
 
-    def test_conversations_storage(self):
-        """Test storing and retrieving conversations."""
-        conversations.clear()
+        del store["a"]
 
-        conversations["resp_123"] = {
-            "request": {"model": DEFAULT_MODEL, "input": "Hello"},
-            "response": {"id": "resp_123", "output": []}
-        }
+        assert evicted == ["a"]
+        assert len(store) == 0
+        with pytest.raises(KeyError):
+            del store["a"]
 
-        assert "resp_123" in conversations
-        assert conversations["resp_123"]["request"]["input"] == "Hello"
+    def test_conversation_eviction_drops_session_id(self, monkeypatch):
+        """Test that evicting a conversation also forgets its session ID."""
+        monkeypatch.setattr(conversations, "_capacity", 1)
 
-        conversations.clear()
+        session_ids["resp_1"] = "session_1"
+        conversations["resp_1"] = {"response": {}}
+        conversations["resp_2"] = {"response": {}}
+
+        assert "resp_1" not in conversations
+        assert "resp_1" not in session_ids
+
+
+@pytest.mark.unit
+class TestClientPool:
+    """Test the warm client pool."""
+
+    @patch("main.create_client")
+    async def test_disabled_pool_creates_client(self, mock_create_client, monkeypatch):
+        """Test that a pool size of 0 creates a client per request."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 0)
+        mock_create_client.return_value = AsyncMock()
+
+        await acquire_client(DEFAULT_MODEL)
+        await asyncio.sleep(0)
+
+        assert mock_create_client.call_count == 1
+
+    @patch("main.create_client")
+    async def test_new_conversation_uses_warm_client(self, mock_create_client, monkeypatch):
+        """Test that new conversations take a pre-connected client and refill."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 1)
+        clients = [AsyncMock(), AsyncMock(), AsyncMock()]
+        mock_create_client.side_effect = clients
+
+        try:
+            # Empty pool: connect on demand and warm one in the background
+            first = await acquire_client(DEFAULT_MODEL)
+            await asyncio.sleep(0)
+            assert first is clients[0]
+
+            second = await acquire_client(DEFAULT_MODEL)
+            await asyncio.sleep(0)
+            assert second is clients[1]
+            assert mock_create_client.call_count == 3
+        finally:
+            await drain_client_pool()
+
+        clients[2].disconnect.assert_called_once()
+
+    @patch("main.create_client")
+    async def test_resumed_conversation_bypasses_pool(self, mock_create_client, monkeypatch):
+        """Test that resuming a session never takes a warm client."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 1)
+        mock_create_client.return_value = AsyncMock()
+
+        await acquire_client(DEFAULT_MODEL, resume_session_id="session_prev")
+        await asyncio.sleep(0)
+
+        mock_create_client.assert_called_once_with(
+            DEFAULT_MODEL, "session_prev", enable_streaming=False
+        )
+
+    @patch("main.create_client")
+    async def test_unlisted_model_bypasses_pool(self, mock_create_client, monkeypatch):
+        """Test that models outside CLIENT_POOL_MODELS never get a pool."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 1)
+        mock_create_client.return_value = AsyncMock()
+
+        await acquire_client("unlisted-model")
+        await asyncio.sleep(0)
+
+        mock_create_client.assert_called_once_with(
+            "unlisted-model", None, enable_streaming=False
+        )
+
+    @patch("main.create_client")
+    async def test_refill_waits_for_concurrency_slot(self, mock_create_client, monkeypatch):
+        """Test that background refills hold a Claude semaphore slot."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 1)
+        semaphore = asyncio.Semaphore(1)
+        monkeypatch.setattr("main.claude_semaphore", semaphore)
+        mock_create_client.side_effect = lambda *args, **kwargs: AsyncMock()
+
+        try:
+            async with semaphore:
+                await acquire_client(DEFAULT_MODEL)
+                await asyncio.sleep(0)
+                assert mock_create_client.call_count == 1
+
+            await asyncio.sleep(0)
+            assert mock_create_client.call_count == 2
+        finally:
+            await drain_client_pool()
+
+    @patch("main.create_client")
+    async def test_drain_survives_disconnect_error(self, mock_create_client, monkeypatch):
+        """Test that one failing disconnect doesn't stop the rest of the drain."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 2)
+        clients = [AsyncMock(), AsyncMock(), AsyncMock()]
+        clients[1].disconnect.side_effect = RuntimeError("boom")
+        mock_create_client.side_effect = clients
+
+        await acquire_client(DEFAULT_MODEL)
+        await asyncio.sleep(0)
+        await drain_client_pool()
+
+        clients[1].disconnect.assert_called_once()
+        clients[2].disconnect.assert_called_once()
+
+    @patch("main.create_client")
+    async def test_drain_waits_for_cancelled_refills(self, mock_create_client, monkeypatch):
+        """Test that draining waits for in-flight refills to finish cancelling."""
+        monkeypatch.setattr("main.CLIENT_POOL_SIZE", 1)
+        unwound = asyncio.Event()
+
+        connects = 0
+
+        # The on-demand connect returns at once; the background refill hangs
+        async def connect(*args, **kwargs):
+            nonlocal connects
+            connects += 1
+            if connects == 1:
+                return AsyncMock()
+            try:
+                await asyncio.sleep(60)
+            finally:
+                unwound.set()
+
+        mock_create_client.side_effect = connect
+
+        await acquire_client(DEFAULT_MODEL)
+        await asyncio.sleep(0)
+        await drain_client_pool()
+
+        assert unwound.is_set()
@@ -2,10 +2,12 @@
 Live end-to-end tests that hit the real Claude API.
 These tests are skipped if ANTHROPIC_API_KEY is not set.
 """
+import asyncio
 import os
 import pytest
-import json
+import pytest_asyncio
 from .test_config import DEFAULT_MODEL
+from .helpers import parse_sse
 
 # Skip all tests in this module if API key is missing
 pytestmark = [
@@ -16,66 +18,88 @@ pytestmark = [
     )
 ]
 
+# Request payloads, copied before each post so tests never share mutations
+_LIVE_SIMPLE_REQ = {
+    "model": DEFAULT_MODEL,
+    "input": "Say 'hello world' and nothing else.",
+    "stream": False,
+    "store": True,
+}
+
+_LIVE_STREAM_REQ = {
+    "model": DEFAULT_MODEL,
+    "input": "Count from 1 to 3.",
+    "stream": True,
+    "store": True,
+}
+
+
+@pytest_asyncio.fixture(scope="module", loop_scope="session")
+async def live_responses(_client):
+    """
+    Send the simple and streaming requests once, concurrently, for the module.
+
+    The two requests are independent, so overlapping their round trips to the
+    API halves the wait. Exceptions are kept per request, so a failure in one
+    only fails the test that reads it.
+    """
+    # Ensure we are NOT mocking the client
+    # The client uses the app, which uses call_claude_agent
+    # We just need to make sure we don't patch it
+    simple, streaming = await asyncio.gather(
+        _client.post("/v1/responses", json={**_LIVE_SIMPLE_REQ}),
+        _client.post("/v1/responses", json={**_LIVE_STREAM_REQ}),
+        return_exceptions=True,
+    )
+    return {"simple": simple, "streaming": streaming}
+
+
+def _live_response(live_responses, name):
+    """Return one of the live responses, re-raising its error if it failed."""
+    response = live_responses[name]
+    if isinstance(response, BaseException):
+        raise response
+    return response
+
 
 @pytest.mark.live
 class TestLiveConversation:
     """Live tests against real Claude API."""
 
-    async def test_simple_live_conversation(self, test_client, sample_request_data):
+    async def test_simple_conversation(self, live_responses):
         """Test a simple conversation with the real API."""
-        # Use model from environment
-        sample_request_data["model"] = DEFAULT_MODEL
-        sample_request_data["input"] = "Say 'hello world' and nothing else."
-        
-        # Ensure we are NOT mocking the client
-        # The test_client fixture uses the app, which uses call_claude_agent
-        # We just need to make sure we don't patch it
-        
-        response = await test_client.post("/v1/responses", json=sample_request_data)
-        
+        response = _live_response(live_responses, "simple")
+
         assert response.status_code == 200
         data = response.json()
-        
+
         assert data["status"] == "completed"
         assert len(data["output"]) > 0
         text = data["output"][0]["content"][0]["text"]
         assert "hello world" in text.lower()
-        
+
         # Verify usage is real (non-zero)
         assert data["usage"]["input_tokens"] > 0
         assert data["usage"]["output_tokens"] > 0
 
-    async def test_live_streaming_conversation(self, test_client, sample_request_data):
-        """Test streaming conversation with real API."""
-        sample_request_data["model"] = DEFAULT_MODEL
-        sample_request_data["input"] = "Count from 1 to 3."
-        sample_request_data["stream"] = True
-        
-        response = await test_client.post("/v1/responses", json=sample_request_data)
-        
-        assert response.status_code == 200
-        assert response.headers["content-type"] == "text/event-stream; charset=utf-8"
-        
-        content = response.text
-        events = []
-        full_text = ""
-        
-        for line in content.split("\n"):
-            if line.startswith("event: "):
-                events.append(line.replace("event: ", "").strip())
-            if line.startswith("data: "):
-                data_str = line.replace("data: ", "")
-                try:
-                    data = json.loads(data_str)
-                    if data.get("type") == "response.output_text.delta":
-                        full_text += data.get("delta", "")
-                except json.JSONDecodeError:
-                    pass
-        
+    async def test_streaming_conversation(self, live_responses):
+        """Test a streaming conversation with the real API."""
+        streaming_response = _live_response(live_responses, "streaming")
+
+        assert streaming_response.status_code == 200
+        assert streaming_response.headers["content-type"] == "text/event-stream; charset=utf-8"
+
+        parsed = parse_sse(streaming_response.content)
+        events = [event_type for event_type, _ in parsed]
+        full_text = "".join(
+            data["delta"] for event_type, data in parsed
+            if event_type == "response.output_text.delta"
+        )
+
         assert "response.created" in events
         assert "response.output_text.delta" in events
         assert "response.completed" in events
-        
+
         assert "1" in full_text
         assert "2" in full_text
         assert "3" in full_text
@@ -17,100 +17,73 @@ from main import (
 class TestOutputTextContent:
     """Test OutputTextContent model."""
 
-    def test_create_valid_content(self):
-        """Test creating valid output text content."""
-        content = OutputTextContent(text="Hello, world!")
+    @pytest.mark.parametrize("kwargs,annotations", [
+        ({}, []),
+        ({"annotations": ["annotation1", "annotation2"]}, ["annotation1", "annotation2"]),
+    ], ids=["default_annotations", "with_annotations"])
+    def test_content(self, kwargs, annotations):
+        """Test creating output text content with and without annotations."""
+        content = OutputTextContent(text="Hello, world!", **kwargs)
+
         assert content.type == "output_text"
         assert content.text == "Hello, world!"
-        assert content.annotations == []
-
-    def test_default_annotations(self):
-        """Test default empty annotations list."""
-        content = OutputTextContent(text="Test")
-        assert isinstance(content.annotations, list)
-        assert len(content.annotations) == 0
-
-    def test_with_annotations(self):
-        """Test content with annotations."""
-        content = OutputTextContent(
-            text="Test",
-            annotations=["annotation1", "annotation2"]
-        )
-        assert len(content.annotations) == 2
+        assert content.annotations == annotations
 
 
 @pytest.mark.unit
 class TestMessageOutput:
     """Test MessageOutput model."""
 
-    def test_create_valid_message(self):
-        """Test creating valid message output."""
-        content = OutputTextContent(text="Hello!")
+    @pytest.mark.parametrize("texts", [
+        ["Hello!"],
+        ["Part 1", "Part 2"],
+    ], ids=["single_block", "multiple_blocks"])
+    def test_message(self, texts):
+        """Test creating message output with one or more content blocks."""
         message = MessageOutput(
             id="msg_123",
-            content=[content]
+            content=[OutputTextContent(text=text) for text in texts]
         )
         assert message.type == "message"
         assert message.id == "msg_123"
         assert message.status == "completed"
         assert message.role == "assistant"
-        assert len(message.content) == 1
-
-    def test_multiple_content_blocks(self):
-        """Test message with multiple content blocks."""
-        message = MessageOutput(
-            id="msg_123",
-            content=[
-                OutputTextContent(text="Part 1"),
-                OutputTextContent(text="Part 2"),
-            ]
-        )
-        assert len(message.content) == 2
+        assert [block.text for block in message.content] == texts
 
 
 @pytest.mark.unit
 class TestUsageInfo:
     """Test UsageInfo model."""
 
-    def test_create_valid_usage(self):
-        """Test creating valid usage info."""
-        usage = UsageInfo(
-            input_tokens=100,
-            output_tokens=200,
-            total_tokens=300
-        )
-        assert usage.input_tokens == 100
-        assert usage.output_tokens == 200
-        assert usage.total_tokens == 300
-
-    def test_zero_tokens(self):
-        """Test usage with zero tokens."""
+    @pytest.mark.parametrize("input_tokens,output_tokens,total", [
+        (100, 200, 300),
+        (0, 0, 0),
+    ], ids=["nonzero", "zero"])
+    def test_usage(self, input_tokens, output_tokens, total):
+        """Test creating usage info."""
         usage = UsageInfo(
-            input_tokens=0,
-            output_tokens=0,
-            total_tokens=0
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            total_tokens=total
         )
-        assert usage.input_tokens == 0
-        assert usage.total_tokens == 0
+        assert usage.input_tokens == input_tokens
+        assert usage.output_tokens == output_tokens
+        assert usage.total_tokens == total
 
 
 @pytest.mark.unit
 class TestResponseObject:
     """Test ResponseObject model."""
 
-    def test_create_valid_response(self):
+    def test_create_valid_response(self, sample_message, sample_usage):
         """Test creating valid response object."""
-        content = OutputTextContent(text="Hello!")
-        message = MessageOutput(id="msg_123", content=[content])
-        usage = UsageInfo(input_tokens=10, output_tokens=20, total_tokens=30)
-
         response = ResponseObject(
             id="resp_123",
             created_at=1234567890,
             status="completed",
             model=DEFAULT_MODEL,
-            output=[message],
-            usage=usage
+            output=[sample_message],
+            usage=sample_usage
         )
 
         assert response.id == "resp_123"
@@ -119,39 +92,27 @@ class TestResponseObject:
         assert response.store is True
         assert len(response.output) == 1
 
-    def test_default_metadata(self):
+    def test_default_metadata(self, sample_response):
         """Test default empty metadata dict."""
-        content = OutputTextContent(text="Test")
-        message = MessageOutput(id="msg_123", content=[content])
-        usage = UsageInfo(input_tokens=1, output_tokens=1, total_tokens=2)
-
-        response = ResponseObject(
-            id="resp_123",
-            created_at=1234567890,
-            model=DEFAULT_MODEL,
-            output=[message],
-            usage=usage
-        )
+        assert isinstance(sample_response.metadata, dict)
+        assert len(sample_response.metadata) == 0
 
-        assert isinstance(response.metadata, dict)
-        assert len(response.metadata) == 0
-
-    def test_with_metadata(self):
+    def test_with_metadata(self, sample_response):
         """Test response with metadata."""
-        content = OutputTextContent(text="Test")
-        message = MessageOutput(id="msg_123", content=[content])
-        usage = UsageInfo(input_tokens=1, output_tokens=1, total_tokens=2)
-
-        response = ResponseObject(
-            id="resp_123",
-            created_at=1234567890,
-            model=DEFAULT_MODEL,
-            output=[message],
-            usage=usage,
-            metadata={"test_key": "test_value"}
+        response = sample_response.model_copy(
+            update={"metadata": {"test_key": "test_value"}}
         )
 
         assert response.metadata["test_key"] == "test_value"
+        assert sample_response.metadata == {}
+
+    def test_is_immutable(self, sample_response):
+        """Test output models reject assignment and unknown fields."""
+        with pytest.raises(ValidationError):
+            sample_response.status = "failed"
+
+        with pytest.raises(ValidationError):
+            UsageInfo(input_tokens=1, output_tokens=1, total_tokens=2, cached_tokens=0)
 
 
 @pytest.mark.unit
@@ -202,21 +163,10 @@ class TestCreateResponseRequest:
 class TestStreamingEvents:
     """Test streaming event models."""
 
-    def test_response_created_event(self):
+    def test_response_created_event(self, sample_response):
         """Test ResponseCreatedEvent model."""
-        content = OutputTextContent(text="Test")
-        message = MessageOutput(id="msg_123", content=[content])
-        usage = UsageInfo(input_tokens=1, output_tokens=1, total_tokens=2)
-        response = ResponseObject(
-            id="resp_123",
-            created_at=1234567890,
-            model=DEFAULT_MODEL,
-            output=[message],
-            usage=usage
-        )
-
         event = ResponseCreatedEvent(
-            response=response,
+            response=sample_response,
             sequence_number=0
         )
 
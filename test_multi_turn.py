@@ -3,104 +3,231 @@ Test multi-turn conversation streaming to reproduce the hang bug.
 """
 import os
 import asyncio
+from typing import Annotated, Any, List, Literal, Union
 import httpx
+import orjson
+import pytest
+import pytest_asyncio
 from dotenv import load_dotenv
+from pydantic import BaseModel, Discriminator, Tag, TypeAdapter
 
-# Load environment variables
-load_dotenv()
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
-# Default model from environment with fallback
-DEFAULT_MODEL = os.getenv("MODEL_NAME", "claude-haiku-4-5-20251001")
+# SSE framing, as bytes so frames are never decoded to str
+_FRAME_END = b'\n\n'
+_EVENT = b'event: '
+_EVENT_LEN = len(_EVENT)
+_DATA = b'data: '
+_DATA_LEN = len(_DATA)
+_COMPLETED = b'response.completed'
 
+# Request fields for each turn; the model comes from the environment and the
+# second turn also carries the first turn's previous_response_id
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+_BODY1_FIELDS = {
+    'input': 'Say hello in one word',
+    'stream': True,
+    'store': True,
+}
+_BODY2_FIELDS = {
+    'input': 'Now say goodbye in one word',
+    'stream': True,
+    'store': True,
+}
+
+
+# Event models for the fields this script reads, defined here so the script
+# stays independent of the backend package. Extra fields are ignored.
+class ResponseRef(BaseModel):
+    id: str
+
+
+class ResponseCreatedEvent(BaseModel):
+    type: Literal['response.created']
+    response: ResponseRef
+
+
+class TextDeltaEvent(BaseModel):
+    type: Literal['response.output_text.delta']
+    delta: str
+
+
+class ResponseCompletedEvent(BaseModel):
+    type: Literal['response.completed']
+    response: ResponseRef
+
+
+class OtherEvent(BaseModel):
+    """Any event type the script doesn't inspect."""
+    type: str
+
+
+_TYPED_EVENTS = {
+    'response.created',
+    'response.output_text.delta',
+    'response.completed',
+}
+
+
+def _event_tag(event: Any) -> str:
+    event_type = event.get('type') if isinstance(event, dict) else getattr(event, 'type', None)
+    return event_type if event_type in _TYPED_EVENTS else 'other'
 
-async def read_sse_events(response, timeout_seconds=7):
-    """Read SSE events from a streaming response with timeout."""
-    import json
-    events = []
 
-    async def read_events():
-        async for line in response.aiter_lines():
-            if line.startswith('data: '):
-                data = json.loads(line[6:])  # Remove 'data: ' prefix
-                events.append(data)
-                print(f"[DEBUG] Received event: {data.get('type')}")
+SseEvent = Annotated[
+    Union[
+        Annotated[ResponseCreatedEvent, Tag('response.created')],
+        Annotated[TextDeltaEvent, Tag('response.output_text.delta')],
+        Annotated[ResponseCompletedEvent, Tag('response.completed')],
+        Annotated[OtherEvent, Tag('other')],
+    ],
+    Discriminator(_event_tag),
+]
 
-                # Stop when we get response.completed
-                if data.get('type') == 'response.completed':
-                    break
+# Validates a whole stream's events into typed models in one call
+_EVENTS_ADAPTER = TypeAdapter(List[SseEvent])
 
+
+def parse_events(raw):
+    """Validate collected data payloads into typed events in one pass."""
+    return _EVENTS_ADAPTER.validate_json(b'[' + b','.join(raw) + b']')
+
+
+def load_default_model():
+    """Default model from environment (after loading .env) with fallback."""
+    load_dotenv()
+    return os.getenv("MODEL_NAME", "claude-haiku-4-5-20251001")
+
+
+@pytest.fixture(scope="session")
+def default_model():
+    """Load .env only when a test actually runs, not at collection."""
+    return load_default_model()
+
+
+def make_http_client():
+    """
+    Client for the local backend; keeps connections alive between turns.
+
+    HTTP/1.1 only: uvicorn doesn't serve HTTP/2, so http2=True would gain
+    nothing here.
+    """
+    return httpx.AsyncClient(
+        base_url='http://localhost:8000',
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=4),
+    )
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def http_client():
+    """One client (and connection pool) shared by every test in the session."""
+    async with make_http_client() as client:
+        yield client
+
+
+async def read_sse_events(response, timeout_seconds=7):
+    """Read SSE events from a streaming response with timeout."""
+    raw = []
+    append = raw.append
+
+    # Split raw bytes into frames on the blank line ending each event and
+    # collect the data lines; the event line is enough to spot the end of the
+    # stream, so validation waits until all frames are in
+    buffer = bytearray()
     try:
-        await asyncio.wait_for(read_events(), timeout=timeout_seconds)
-    except asyncio.TimeoutError:
+        async with asyncio.timeout(timeout_seconds):
+            async for chunk in response.aiter_bytes():
+                buffer += chunk
+                while (end := buffer.find(_FRAME_END)) != -1:
+                    frame = bytes(buffer[:end])
+                    del buffer[:end + len(_FRAME_END)]
+                    event_type = b''
+                    for line in frame.split(b'\n'):
+                        if line.startswith(_EVENT):
+                            event_type = line[_EVENT_LEN:]
+                        elif line.startswith(_DATA):
+                            append(line[_DATA_LEN:])
+                    print(f"[DEBUG] Received event: {event_type.decode()}")
+
+                    # Stop when we get response.completed
+                    if event_type == _COMPLETED:
+                        return parse_events(raw)
+    except TimeoutError:
         print(f"[ERROR] Timeout after {timeout_seconds}s waiting for SSE events")
-        print(f"[ERROR] Received {len(events)} events before timeout")
-        raise AssertionError(f"Timeout after {timeout_seconds}s - only received {len(events)} events")
+        print(f"[ERROR] Received {len(raw)} events before timeout")
+        raise AssertionError(f"Timeout after {timeout_seconds}s - only received {len(raw)} events")
 
-    return events
+    return parse_events(raw)
 
 
-async def test_multi_turn_streaming():
+async def test_multi_turn_streaming(http_client, default_model):
     """Test that multi-turn conversations work with streaming."""
     print("[TEST] Starting test_multi_turn_streaming")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        # First request
-        print("\n[TEST] Sending first request...")
-        response1 = await client.post(
-            'http://localhost:8000/v1/responses',
-            json={
-                'model': DEFAULT_MODEL,
-                'input': 'Say hello in one word',
-                'stream': True,
-                'store': True,
-            },
-            headers={'Content-Type': 'application/json'}
-        )
+    # First request
+    print("\n[TEST] Sending first request...")
+    response1 = await http_client.post(
+        '/v1/responses',
+        content=orjson.dumps({**_BODY1_FIELDS, 'model': default_model}),
+        headers=_JSON_HEADERS
+    )
 
-        assert response1.status_code == 200, f"First request failed: {response1.status_code}"
+    assert response1.status_code == 200, f"First request failed: {response1.status_code}"
 
-        # Read first response events
-        print("[TEST] Reading first response events...")
-        events1 = await read_sse_events(response1)
+    # Read first response events
+    print("[TEST] Reading first response events...")
+    events1 = await read_sse_events(response1)
 
-        assert len(events1) > 0, "First request received no events"
+    assert len(events1) > 0, "First request received no events"
 
-        # Find response.completed event and extract ID
-        completed_events = [e for e in events1 if e.get('type') == 'response.completed']
-        assert len(completed_events) == 1, f"Expected 1 completed event, got {len(completed_events)}"
+    # Reading stops at response.completed, so it is the last event
+    assert isinstance(events1[-1], ResponseCompletedEvent), \
+        f"Expected response.completed last, got {events1[-1].type}"
 
-        response_id = completed_events[0]['response']['id']
-        print(f"[TEST] First response completed with ID: {response_id}")
+    response_id = events1[-1].response.id
+    assert isinstance(events1[0], ResponseCreatedEvent) and events1[0].response.id == response_id, \
+        "Expected response.created first, for the same response"
+    print(f"[TEST] First response completed with ID: {response_id}")
 
-        # Second request with previous_response_id
-        print(f"\n[TEST] Sending second request with previous_response_id={response_id}...")
-        response2 = await client.post(
-            'http://localhost:8000/v1/responses',
-            json={
-                'model': DEFAULT_MODEL,
-                'input': 'Now say goodbye in one word',
-                'stream': True,
-                'store': True,
-                'previous_response_id': response_id,
-            },
-            headers={'Content-Type': 'application/json'}
-        )
+    # Second request with previous_response_id
+    print(f"\n[TEST] Sending second request with previous_response_id={response_id}...")
+    response2 = await http_client.post(
+        '/v1/responses',
+        content=orjson.dumps({
+            **_BODY2_FIELDS,
+            'model': default_model,
+            'previous_response_id': response_id,
+        }),
+        headers=_JSON_HEADERS
+    )
 
-        assert response2.status_code == 200, f"Second request failed: {response2.status_code}"
+    assert response2.status_code == 200, f"Second request failed: {response2.status_code}"
 
-        # Read second response events - this is where it hangs
-        print("[TEST] Reading second response events (this should hang if bug is present)...")
-        events2 = await read_sse_events(response2, timeout_seconds=7)
+    # Read second response events - this is where it hangs
+    print("[TEST] Reading second response events (this should hang if bug is present)...")
+    events2 = await read_sse_events(response2, timeout_seconds=7)
 
-        assert len(events2) > 0, "Second request received no events (hung!)"
+    assert len(events2) > 0, "Second request received no events (hung!)"
 
-        # Verify we got a completed event
-        completed_events2 = [e for e in events2 if e.get('type') == 'response.completed']
-        assert len(completed_events2) == 1, f"Expected 1 completed event in second response, got {len(completed_events2)}"
+    # Verify we got a completed event
+    assert isinstance(events2[-1], ResponseCompletedEvent), \
+        f"Expected response.completed last in second response, got {events2[-1].type}"
 
-        print("[TEST] ✓ Multi-turn streaming works correctly!")
+    print("[TEST] ✓ Multi-turn streaming works correctly!")
 
 
 if __name__ == '__main__':
+    async def main():
+        async with make_http_client() as client:
+            await test_multi_turn_streaming(client, load_default_model())
+
     print("[TEST] Script starting...")
-    asyncio.run(test_multi_turn_streaming())
+    # Same loop the backend gets from uvicorn's loop="auto"
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())